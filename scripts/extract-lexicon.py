@@ -7,6 +7,8 @@ parser = argparse.ArgumentParser()
 parser.add_argument('source_file')
 parser.add_argument('target_file')
 parser.add_argument('align_file')
+parser.add_argument('-k', '--top-k', type=int, default=1,
+                    help='number of translations per source word (from the most frequent alignment to the least)')
 
 args = parser.parse_args()
 
@@ -37,7 +39,7 @@ src_vocab = list(src_vocab.keys())
 trg_vocab = list(trg_vocab.keys())
 
 for source, counts_ in counts.items():
-    target = max(counts_.keys(), key=lambda word: counts_[word])
+    targets = sorted(counts_.keys(), key=lambda word: counts_[word], reverse=True)[:args.top_k]
     source = src_vocab[source]
-    target = trg_vocab[target]
-    print(source, target)
+    for target in targets:
+        print(source, trg_vocab[target])
@@ -4,8 +4,15 @@ import numpy as np
 import scipy.io.wavfile as wav
 import tarfile
 import sys
+import os
 from python_speech_features import mfcc, delta, fbank
 
+script_dir = os.path.dirname(os.path.abspath(__file__))
+root_dir = os.path.dirname(os.path.dirname(script_dir))
+sys.path.append(root_dir)
+
+from translate import utils
+
 parser = argparse.ArgumentParser()
 parser.add_argument('inputs', nargs='+')
 parser.add_argument('output')
@@ -22,6 +29,8 @@ parser.add_argument('--nfft', type=int, default=512)
 parser.add_argument('--low-freq', type=float, default=0)
 parser.add_argument('--high-freq', type=float)
 parser.add_argument('-v', '--verbose', action='store_true')
+parser.add_argument('--indexed', action='store_true', help='write features in the indexed format, which can be '
+                                                           'memory-mapped by the data loader')
 
 args = parser.parse_args()
 
@@ -45,8 +54,6 @@ params = dict(
         highfreq=args.high_freq,
         nfft=args.nfft)
 
-outfile = open(args.output, 'wb')
-
 total = 0
 for filename in args.inputs:
     tar = tarfile.open(filename)
@@ -63,44 +70,50 @@ if args.energy:
 if args.verbose:
     print('count: {}, dim: {}'.format(total, dim))
 
-np.save(outfile, (total, dim))
 
-i = 1
-for filename in args.inputs:
-    tar = tarfile.open(filename)
-    files = [f for f in tar.getmembers() if f.isfile()]
-    files = sorted(files, key=lambda f: f.name)
-
-    for fileinfo in files:
-        with tar.extractfile(fileinfo) as f:
-            rate, data = wav.read(f)
-            
-            if args.mfcc:
-                feats = mfcc(data, rate, ceplifter=0, **params)
-                energy = feats[:,:1]
-                feats = feats[:,1:]
-            else:
-                feats, energy = fbank(data, rate, **params)
-                feats = np.log(feats)
-                energy = np.expand_dims(np.log(energy), axis=1)
-
-            if args.delta:
-                d1 = delta(feats, 2)
-                feats = np.concatenate([feats, d1], axis=1)
-                if args.delta_delta:
-                    d2 = delta(d1, 2)
-                    feats = np.concatenate([feats, d2], axis=1)
-
-            if args.energy:
-                feats = np.concatenate([energy, feats], axis=1)
-               
-            np.save(outfile, feats)
-        if args.verbose and i % 10 == 0:
-            sys.stdout.write('\rfiles processed: {}'.format(i))
-        i += 1
+def extract_features():
+    i = 1
+    for filename in args.inputs:
+        tar = tarfile.open(filename)
+        files = [f for f in tar.getmembers() if f.isfile()]
+        files = sorted(files, key=lambda f: f.name)
 
-if args.verbose:
-    print('\rfiles processed: {}'.format(i))
+        for fileinfo in files:
+            with tar.extractfile(fileinfo) as f:
+                rate, data = wav.read(f)
 
-outfile.close()
+                if args.mfcc:
+                    feats = mfcc(data, rate, ceplifter=0, **params)
+                    energy = feats[:,:1]
+                    feats = feats[:,1:]
+                else:
+                    feats, energy = fbank(data, rate, **params)
+                    feats = np.log(feats)
+                    energy = np.expand_dims(np.log(energy), axis=1)
 
+                if args.delta:
+                    d1 = delta(feats, 2)
+                    feats = np.concatenate([feats, d1], axis=1)
+                    if args.delta_delta:
+                        d2 = delta(d1, 2)
+                        feats = np.concatenate([feats, d2], axis=1)
+
+                if args.energy:
+                    feats = np.concatenate([energy, feats], axis=1)
+
+                yield feats
+            if args.verbose and i % 10 == 0:
+                sys.stdout.write('\rfiles processed: {}'.format(i))
+            i += 1
+
+    if args.verbose:
+        print('\rfiles processed: {}'.format(i))
+
+
+if args.indexed:
+    utils.write_indexed_features(args.output, extract_features(), dim)
+else:
+    with open(args.output, 'wb') as outfile:
+        np.save(outfile, (total, dim))
+        for feats in extract_features():
+            np.save(outfile, feats)
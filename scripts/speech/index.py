@@ -0,0 +1,32 @@
+#!/usr/bin/env python3
+import argparse
+import os
+import sys
+import numpy as np
+
+script_dir = os.path.dirname(os.path.abspath(__file__))
+root_dir = os.path.dirname(os.path.dirname(script_dir))
+sys.path.append(root_dir)
+
+from translate import utils
+
+help_msg = """\
+Convert a feature file from the sequential format (concatenated numpy arrays, as created by
+`extract-new.py`) to the indexed format, which can be memory-mapped by the training data loader.
+"""
+
+parser = argparse.ArgumentParser(description=help_msg)
+parser.add_argument('input')
+parser.add_argument('output')
+parser.add_argument('-v', '--verbose', action='store_true')
+
+args = parser.parse_args()
+
+with open(args.input, 'rb') as input_file:
+    n, dim = np.load(input_file)
+
+if args.verbose:
+    print('count: {}, dim: {}'.format(n, dim))
+
+features = (feats for feats, _ in utils.read_binary_features(args.input))
+utils.write_indexed_features(args.output, features, dim)
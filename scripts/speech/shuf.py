@@ -1,8 +1,16 @@
 #!/usr/bin/env python3
 import argparse
 import random
+import os
+import sys
 import numpy as np
 
+script_dir = os.path.dirname(os.path.abspath(__file__))
+root_dir = os.path.dirname(os.path.dirname(script_dir))
+sys.path.append(root_dir)
+
+from translate import utils
+
 parser = argparse.ArgumentParser()
 parser.add_argument('input')
 parser.add_argument('--output')
@@ -18,26 +26,35 @@ if not args.output:
 if args.input_txt and not args.output_txt:
     args.output_txt = args.input_txt
 
-with open(args.input, 'rb') as input_file:
-    n, dim = np.load(input_file)
+# random access to the entries, instead of loading all of them into memory
+indexed = utils.is_indexed_features(args.input)
+if indexed:
+    table, data = utils.read_indexed_features(args.input)
+    n, dim = len(table), data.shape[1]
+else:
+    offsets, dim = utils.scan_binary_features(args.input)
+    n = len(offsets)
 
-    indices = list(range(n))
-    random.shuffle(indices)
+indices = list(range(n))
+random.shuffle(indices)
 
-    if args.n > 0:
-        indices = indices[:args.n]
+if args.n > 0:
+    indices = indices[:args.n]
 
-    frames = []
+# the output file can be the same as the input file
+tmp_output = '{}.{}.tmp'.format(args.output, os.getpid())
 
-    for _ in range(n):
-        feats = np.load(input_file)
-        frames.append(feats)
+if indexed:
+    utils.write_indexed_features(tmp_output, utils.read_features_at(args.input, indices), dim)
+else:
+    with open(args.input, 'rb') as input_file, open(tmp_output, 'wb') as output_file:
+        np.save(output_file, (len(indices), dim))
+        for index in indices:
+            input_file.seek(offsets[index])
+            feats = np.load(input_file)
+            np.save(output_file, feats)
 
-with open(args.output, 'wb') as output_file:
-    np.save(output_file, (len(indices), dim))
-    for index in indices:
-        feats = frames[index]
-        np.save(output_file, feats)
+os.replace(tmp_output, args.output)
 
 if args.input_txt and args.output_txt:
     lines = []
@@ -50,4 +67,3 @@ if args.input_txt and args.output_txt:
             for index in indices:
                 line = lines_[index]
                 output_file.write(line)
-
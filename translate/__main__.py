@@ -35,6 +35,8 @@ parser.add_argument('--align', nargs='*', help='translate and show alignments by
 parser.add_argument('--eval', nargs='*', help='compute BLEU score on this corpus (corpus name or source files and target file)')
 parser.add_argument('--train', action='store_true', help='train an NMT model')
 parser.add_argument('--save', action='store_true')
+parser.add_argument('--eval-worker', action='store_true', help='evaluate the checkpoints of a training process as they '
+                                                               'are saved (see `background_eval`)')
 
 # TensorFlow configuration
 parser.add_argument('--gpu-id', type=int, help='index of the GPU where to run the computation')
@@ -72,6 +74,7 @@ parser.add_argument('--seed', type=int)
 parser.add_argument('--reverse', action='store_true')
 
 parser.add_argument('--parallel-iterations', type=int)
+parser.add_argument('--task-index', type=int, help='index of this worker in data-parallel training (set automatically)')
 
 def main(args=None):
     args = parser.parse_args(args)
@@ -103,13 +106,13 @@ def main(args=None):
 
     if not config.debug:
         os.environ['TF_CPP_MIN_LOG_LEVEL'] = '3'  # disable TensorFlow's debugging logs
-    decoding_mode = any(arg is not None for arg in (args.decode, args.eval, args.align))
+    decoding_mode = any(arg is not None for arg in (args.decode, args.eval, args.align)) or args.eval_worker
 
     # enforce parameter constraints
     assert config.steps_per_eval % config.steps_per_checkpoint == 0, (
         'steps-per-eval should be a multiple of steps-per-checkpoint')
     assert decoding_mode or args.train or args.save, (
-        'you need to specify at least one action (decode, eval, align, or train)')
+        'you need to specify at least one action (decode, eval, align, train or eval-worker)')
     assert not (args.average and args.ensemble)
 
     if args.train and args.purge:
@@ -143,7 +146,11 @@ def main(args=None):
     logging_level = logging.DEBUG if args.verbose else logging.INFO
     # always log to stdout in decoding and eval modes (to avoid overwriting precious train logs)
     log_path = os.path.join(config.model_dir, config.log_file)
-    logger = utils.create_logger(log_path if args.train else None)
+    if args.train and config.task_index:   # other workers of data-parallel training use their own log file
+        log_path = '{}.worker{}'.format(log_path, config.task_index)
+    elif args.eval_worker:
+        log_path = '{}.eval'.format(log_path)
+    logger = utils.create_logger(log_path if args.train or args.eval_worker else None)
     logger.setLevel(logging_level)
 
     utils.log('label: {}'.format(config.label))
@@ -202,8 +209,47 @@ def main(args=None):
     random.seed(config.seed)
     tf.set_random_seed(config.tf_seed)
 
+    # synchronous data-parallel training: one process per replica, on a local TensorFlow cluster
+    workers = []
+    cluster_target = None
+    if not args.train or config.replicas is None or config.replicas <= 1:
+        config.replicas = 1
+        config.task_index = 0
+    else:
+        assert config.tasks is None, 'data-parallel training is not supported with multiple tasks'
+        assert config.loss_function == 'xent' and config.sgd_after_n_epoch is None, (
+            'data-parallel training only supports the xent loss, with a single optimizer')
+        if config.task_index is None:   # main process: start the other workers
+            config.task_index = 0
+            argv = [arg for arg in sys.argv[1:] if arg != '--purge']
+            for task_index in range(1, config.replicas):
+                # same seed: all the workers iterate over the same batches, and take one batch out of `replicas`
+                command = [sys.executable, '-m', 'translate'] + argv + ['--task-index', str(task_index),
+                                                                       '--seed', str(config.seed)]
+                workers.append(subprocess.Popen(command))
+
+        hosts = ['localhost:{}'.format(config.replica_port + i) for i in range(config.replicas)]
+        cluster = tf.train.ClusterSpec({'worker': hosts})
+        server = tf.train.Server(cluster, job_name='worker', task_index=config.task_index)
+        cluster_target = server.target
+        utils.log('data-parallel training: worker {} of {}'.format(config.task_index + 1, config.replicas))
+
+    if args.train and config.background_eval and config.task_index == 0:
+        # the dev set is evaluated by another process, which keeps running until all the checkpoints
+        # requested by this training process are evaluated
+        argv = [arg for arg in sys.argv[1:] if arg not in ('--train', '--purge')]
+        subprocess.Popen([sys.executable, '-m', 'translate'] + argv + ['--eval-worker'])
+
+    if args.eval_worker:   # evaluation runs on CPU, with a limited number of threads
+        config.no_gpu = True
+
     device = None
-    if config.no_gpu:
+    if config.replicas > 1:
+        # variables are stored by the first worker, and computation is done locally
+        device = tf.train.replica_device_setter(ps_tasks=1, ps_device='/job:worker/task:0',
+                                                worker_device='/job:worker/task:{}'.format(config.task_index))
+        device_id = None
+    elif config.no_gpu:
         device = '/cpu:0'
         device_id = None
     elif config.gpu_id is not None:
@@ -253,13 +299,16 @@ def main(args=None):
     tf_config = tf.ConfigProto(log_device_placement=False, allow_soft_placement=True)
     tf_config.gpu_options.allow_growth = config.allow_growth
     tf_config.gpu_options.per_process_gpu_memory_fraction = config.mem_fraction
+    if args.eval_worker and config.eval_threads:
+        tf_config.intra_op_parallelism_threads = config.eval_threads
+        tf_config.inter_op_parallelism_threads = config.eval_threads
 
     def average_checkpoints(main_sess, sessions):
         for var in tf.global_variables():
             avg_value = sum(sess.run(var) for sess in sessions) / len(sessions)
             main_sess.run(var.assign(avg_value))
 
-    with tf.Session(config=tf_config) as sess:
+    with tf.Session(target=cluster_target, config=tf_config) as sess:
         best_checkpoint = os.path.join(config.checkpoint_dir, 'best')
 
         params = {'variable_mapping': config.variable_mapping, 'reverse_mapping': config.reverse_mapping}
@@ -271,6 +320,8 @@ def main(args=None):
             for sess_, checkpoint in zip(sessions, config.checkpoints):
                 model.initialize(sess=sess_, checkpoints=[checkpoint], **params)
             average_checkpoints(sess, sessions)
+        elif args.eval_worker:
+            model.initialize(reset=True)   # the checkpoints are loaded as they are saved by the training process
         elif (not config.checkpoints and decoding_mode and
              (os.path.isfile(best_checkpoint + '.index') or os.path.isfile(best_checkpoint + '.index'))):
             # in decoding and evaluation mode, unless specified otherwise (by `checkpoints`),
@@ -288,6 +339,7 @@ def main(args=None):
         try:
             if args.save:
                 model.save()
+                model.wait_for_save()
             elif args.decode is not None:
                 if config.align is not None:
                     config.align = True
@@ -296,10 +348,15 @@ def main(args=None):
                 model.evaluate(on_dev=False, **config)
             elif args.align is not None:
                 model.align(**config)
+            elif args.eval_worker:
+                model.eval_worker(**config)
             elif args.train:
                 model.train(**config)
         except KeyboardInterrupt:
             sys.exit()
+        finally:
+            for worker in workers:   # the other workers may be waiting for the chief's updates
+                worker.terminate()
 
 
 if __name__ == '__main__':
@@ -1,4 +1,5 @@
 import tensorflow as tf
+from tensorflow.python.util import nest
 from translate import utils
 
 
@@ -74,16 +75,62 @@ def softmax(e, temperature=None):
     return weights
 
 
+def tile_beam(tensor, beam_size):
+    """Repeat each element of a batch `beam_size` times: (batch_size, ...) -> (batch_size * beam_size, ...)"""
+    shape = get_shape(tensor)
+    tensor = tf.tile(tf.expand_dims(tensor, axis=1), [1, beam_size] + [1] * (len(shape) - 1))
+    return tf.reshape(tensor, tf.stack([shape[0] * beam_size] + shape[1:]))
+
+
+def shape_invariant(var):
+    """Shape of a loop variable whose first dimension (batch) can vary, while the other static dimensions
+    (e.g., state sizes, which are needed by the dense layers) are kept."""
+    if isinstance(var, tf.TensorArray):
+        return tf.TensorShape(None)
+    elif var.shape.ndims == 0:
+        return var.shape
+    else:
+        return tf.TensorShape([None]).concatenate(var.shape[1:])
+
+
+def backtrace(token_ids, parent_ids):
+    """
+    :param token_ids: tensor of size (seq_len, batch_size, beam_size) containing the token chosen by each beam
+        at each time step
+    :param parent_ids: tensor of the same size, containing the beam (at the previous time step) that each
+        of these tokens extends
+    :return: tensor of size (batch_size, beam_size, seq_len) containing the complete hypotheses that end
+        in each of the final beams
+    """
+    shape = tf.shape(token_ids)
+    time_steps, batch_size, beam_size = shape[0], shape[1], shape[2]
+
+    indices = tf.tile(tf.expand_dims(tf.range(beam_size), axis=0), [batch_size, 1])
+    hypotheses = tf.TensorArray(dtype=tf.int32, size=time_steps, element_shape=tf.TensorShape([None, None]))
+    time = time_steps - 1
+
+    def time_step(time, indices, hypotheses):
+        hypotheses = hypotheses.write(time, batch_gather(token_ids[time], indices))
+        indices = batch_gather(parent_ids[time], indices)
+        return time - 1, indices, hypotheses
+
+    _, _, hypotheses = tf.while_loop(
+        cond=lambda time, *_: time >= 0,
+        body=time_step,
+        loop_vars=(time, indices, hypotheses),
+        back_prop=False)
+
+    return tf.transpose(hypotheses.stack(), perm=[1, 2, 0])
+
+
 def random_sampling(update_funs, initial_states, sequence_length, beam_size, temperature=None, parallel_iterations=16,
                     swap_memory=True):
-    batch_size = tf.shape(initial_states[0])[0]
+    batch_size = tf.shape(nest.flatten(initial_states[0][0])[0])[0]
 
-    state_sizes = [tf.shape(state)[1] for state in initial_states]
-    states = []
-    for initial_state in initial_states:
-        state = tf.tile(tf.expand_dims(initial_state, axis=1), [1, beam_size, 1])
-        states.append(state)
-    states = tf.concat(states, axis=2)
+    # each model has its own state (possibly a tuple of tensors), of size (batch_size * beam_size, ...)
+    states = [nest.map_structure(lambda state: tile_beam(state, beam_size), initial_state)
+              for initial_state, _ in initial_states]
+    encoder_data = [data for _, data in initial_states]
 
     scores = tf.concat([
         tf.ones(shape=[batch_size, 1]),
@@ -91,7 +138,7 @@ def random_sampling(update_funs, initial_states, sequence_length, beam_size, tem
     scores = tf.log(scores)
 
     ids = tf.tile([[utils.BOS_ID]], [batch_size, beam_size])
-    hypotheses = tf.expand_dims(ids, axis=2)
+    hypotheses = tf.TensorArray(dtype=tf.int32, size=0, dynamic_size=True)
     time = tf.constant(0, dtype=tf.int32, name='time')
 
     def time_step(time, hypotheses, states, token_ids):
@@ -99,14 +146,11 @@ def random_sampling(update_funs, initial_states, sequence_length, beam_size, tem
         token_scores = tf.zeros([batch_size, beam_size, 1])
 
         new_states = []
-        states = tf.split(states, num_or_size_splits=len(initial_states), axis=2)
-
-        for k, (state, state_size, update_fun) in enumerate(zip(states, state_sizes, update_funs)):
-            state = tf.reshape(state, [batch_size * beam_size, state_size])
 
+        for k, (state, data, update_fun) in enumerate(zip(states, encoder_data, update_funs)):
             scope = tf.get_variable_scope() if len(update_funs) == 1 else 'model_{}'.format(k + 1)
             with tf.variable_scope(scope, reuse=True):
-                state, logits = update_fun(state, token_ids, time)
+                state, logits = update_fun(state, token_ids, time, data)
 
             new_states.append(state)
 
@@ -120,12 +164,11 @@ def random_sampling(update_funs, initial_states, sequence_length, beam_size, tem
         indices = tf.squeeze(indices, axis=2)
         indices = tf.transpose(indices, [1, 0])
 
-        hypotheses = tf.concat([hypotheses, tf.expand_dims(indices, axis=2)], axis=2)
-        states = tf.concat([tf.expand_dims(state, axis=2) for state in new_states], axis=2)
-        return time + 1, hypotheses, states, indices
+        hypotheses = hypotheses.write(time, indices)
+        return time + 1, hypotheses, new_states, indices
 
     loop_vars = [time, hypotheses, states, ids]
-    shapes = [tf.TensorShape([None] * len(var.shape)) for var in loop_vars]
+    shapes = nest.map_structure(shape_invariant, loop_vars)
 
     def cond(time, *_):
         return time < sequence_length
@@ -138,30 +181,39 @@ def random_sampling(update_funs, initial_states, sequence_length, beam_size, tem
         parallel_iterations=parallel_iterations,
         swap_memory=swap_memory)
 
-    hypotheses = hypotheses[:, :, 1:]  # remove BOS symbol
+    hypotheses = tf.transpose(hypotheses.stack(), perm=[1, 2, 0])
 
     return hypotheses, scores
 
 
 def rnn_beam_search(update_funs, initial_states, sequence_length, beam_size, len_normalization=None,
-                    temperature=None, parallel_iterations=16, swap_memory=True):
+                    temperature=None, parallel_iterations=16, swap_memory=True, shrink_batch=False, output_ids=None):
     """
-    :param update_funs: function to compute the next state and logits given the current state and previous ids
-    :param initial_states: recurrent model states
-    :param sequence_length: maximum output length
+    :param update_funs: function to compute the next state and logits given the current state, the previous ids,
+        the time step and the encoder data
+    :param initial_states: pairs of recurrent model state and encoder data (one for each model), which are both
+        tensors or tuples of tensors of size (batch_size, ...)
+    :param sequence_length: maximum output length (scalar), or maximum output length of each sentence
+        (tensor of size (batch_size,)), after which the hypotheses of this sentence are ended
     :param beam_size: beam size
     :param len_normalization: length normalization coefficient (0 or None for no length normalization)
+    :param shrink_batch: remove from the batch the sentences whose hypotheses have all ended, so that the cost
+        of each step depends on the number of sentences which are still being decoded
+    :param output_ids: when the logits are over a subset of the vocabulary (shortlist), int32 tensor of size
+        (num_classes,) containing the ids of these words (which must include EOS)
     :return: tensor of size (batch_size, beam_size, seq_len) containing the beam-search hypotheses sorted by
         best score (axis 1), and tensor of size (batch_size, beam_size) containing the said scores.
     """
-    batch_size = tf.shape(initial_states[0])[0]
+    batch_size = tf.shape(nest.flatten(initial_states[0][0])[0])[0]
+
+    # each model has its own state (possibly a tuple of tensors), of size (batch_size * beam_size, ...)
+    states = [nest.map_structure(lambda state: tile_beam(state, beam_size), initial_state)
+              for initial_state, _ in initial_states]
+    # the encoder data is shared by all the hypotheses of a sentence: (batch_size, ...)
+    encoder_data = [data for _, data in initial_states]
 
-    state_sizes = [tf.shape(state)[1] for state in initial_states]
-    states = []
-    for initial_state in initial_states:
-        state = tf.tile(tf.expand_dims(initial_state, axis=1), [1, beam_size, 1])
-        states.append(state)
-    states = tf.concat(states, axis=2)
+    max_lengths = tf.convert_to_tensor(sequence_length, dtype=tf.int32) + tf.zeros([batch_size], dtype=tf.int32)
+    sequence_length = tf.reduce_max(max_lengths)
 
     scores = tf.concat([
         tf.ones(shape=[batch_size, 1]),
@@ -169,61 +221,105 @@ def rnn_beam_search(update_funs, initial_states, sequence_length, beam_size, len
     scores = tf.log(scores)
 
     ids = tf.tile([[utils.BOS_ID]], [batch_size, beam_size])
-    hypotheses = tf.expand_dims(ids, axis=2)
+
+    # instead of copying the hypotheses at each step, only keep the new tokens and the beams they extend
+    # (back-pointers), and retrieve the hypotheses at the end
+    token_ids_array = tf.TensorArray(dtype=tf.int32, size=0, dynamic_size=True)
+    parent_ids_array = tf.TensorArray(dtype=tf.int32, size=0, dynamic_size=True)
+
+    # with `shrink_batch`, position in the initial batch of each sentence which is still being decoded,
+    # and outputs of the sentences which are finished
+    batch_ids = tf.range(batch_size)
+    final_scores = scores
+    eos_ids = tf.fill(tf.stack([batch_size, beam_size]), utils.EOS_ID)
+    same_beam_ids = tf.tile(tf.expand_dims(tf.range(beam_size), axis=0), [batch_size, 1])
+
+    if output_ids is None:
+        eos_index = utils.EOS_ID
+    else:   # position of EOS in the shortlist
+        eos_index = tf.to_int32(tf.argmax(tf.to_int32(tf.equal(output_ids, utils.EOS_ID)), axis=0))
 
     mask = tf.ones([batch_size, beam_size], dtype=tf.float32)
     time = tf.constant(0, dtype=tf.int32, name='time')
 
-    def time_step(time, mask, hypotheses, states, token_ids, scores):
-        token_ids = tf.reshape(token_ids, [batch_size * beam_size])
-        token_scores = tf.zeros([batch_size, beam_size, 1])
+    def time_step(time, mask, token_ids_array, parent_ids_array, batch_ids, final_scores, states, encoder_data,
+                  max_lengths, token_ids, scores):
+        live_size = tf.shape(scores)[0]   # number of sentences still being decoded
+        token_ids = tf.reshape(token_ids, [live_size * beam_size])
+        token_scores = tf.zeros([live_size, beam_size, 1])
 
         new_states = []
-        states = tf.split(states, num_or_size_splits=state_sizes, axis=2)
-
-        for k, (state, state_size, update_fun) in enumerate(zip(states, state_sizes, update_funs)):
-            state = tf.reshape(state, [batch_size * beam_size, state_size])
 
+        for k, (state, data, update_fun) in enumerate(zip(states, encoder_data, update_funs)):
             scope = tf.get_variable_scope() if len(update_funs) == 1 else 'model_{}'.format(k + 1)
             with tf.variable_scope(scope, reuse=True):
-                state, logits = update_fun(state, token_ids, time)
+                state, logits = update_fun(state, token_ids, time, data)
 
-            state = tf.reshape(state, [batch_size, beam_size, state_size])
             new_states.append(state)
 
             num_classes = tf.shape(logits)[1]
-            logits = tf.reshape(logits, [batch_size, beam_size, num_classes])
+            logits = tf.reshape(logits, [live_size, beam_size, num_classes])
             token_scores += log_softmax(logits, axis=2, temperature=temperature)
 
         num_classes = tf.shape(token_scores)[2]
-        mask1 = tf.expand_dims(mask, axis=2)
-        mask2 = tf.one_hot(indices=[[utils.EOS_ID]], depth=num_classes)
+        # the hypotheses which have ended, or reached the maximum length of their sentence, can only output EOS
+        mask1 = tf.expand_dims(mask * tf.expand_dims(tf.to_float(time < max_lengths), axis=1), axis=2)
+        mask2 = tf.one_hot(indices=tf.fill([1, 1], eos_index), depth=num_classes)
         token_scores = token_scores * mask1 + (1 - mask1) * (1 - mask2) * -1e30
 
         sum_logprobs = tf.expand_dims(scores, axis=2) + token_scores
 
         scores, indices = tf.nn.top_k(
-            tf.reshape(sum_logprobs, [batch_size, num_classes * beam_size]),
+            tf.reshape(sum_logprobs, [live_size, num_classes * beam_size]),
             k=beam_size)
 
         beam_ids = indices // num_classes
         token_ids = indices % num_classes
-
-        states = tf.concat([batch_gather(state, beam_ids) for state in new_states], axis=2)
-        hypotheses = tf.concat([batch_gather(hypotheses, beam_ids), tf.expand_dims(token_ids, axis=2)], axis=2)
+        if output_ids is not None:   # map the shortlist positions back to vocabulary ids
+            token_ids = tf.gather(output_ids, token_ids)
 
         mask = (batch_gather(mask, beam_ids) * tf.to_float(tf.not_equal(token_ids, utils.EOS_ID)))
-        return time + 1, mask, hypotheses, states, token_ids, scores
-
-    loop_vars = [time, mask, hypotheses, states, ids, scores]
-    shapes = [tf.TensorShape([None] * len(var.shape)) for var in loop_vars]
+        flat_beam_ids = beam_ids + tf.expand_dims(tf.range(live_size) * beam_size, axis=1)
+
+        if shrink_batch:
+            # the sentences which are not in the batch anymore only output EOS (and keep the same beams)
+            indices = tf.expand_dims(batch_ids, axis=1)
+            shape = tf.stack([batch_size, beam_size])
+            is_live = tf.scatter_nd(indices, tf.ones([live_size], dtype=tf.int32), shape[:1]) > 0
+
+            token_ids_array = token_ids_array.write(time, tf.where(is_live, tf.scatter_nd(indices, token_ids, shape),
+                                                                   eos_ids))
+            parent_ids_array = parent_ids_array.write(time, tf.where(is_live, tf.scatter_nd(indices, beam_ids, shape),
+                                                                     same_beam_ids))
+            final_scores = tf.where(is_live, tf.scatter_nd(indices, scores, shape), final_scores)
+
+            # keep the sentences which have at least one unfinished hypothesis
+            live_ids = tf.to_int32(tf.where(tf.reduce_any(mask > 0, axis=1))[:, 0])
+            flat_beam_ids = tf.gather(flat_beam_ids, live_ids)
+            mask, token_ids, scores, batch_ids, max_lengths = [tf.gather(x, live_ids) for x in
+                                                               (mask, token_ids, scores, batch_ids, max_lengths)]
+            encoder_data = [nest.map_structure(lambda x: tf.gather(x, live_ids), data) for data in encoder_data]
+        else:
+            token_ids_array = token_ids_array.write(time, token_ids)
+            parent_ids_array = parent_ids_array.write(time, beam_ids)
+            final_scores = scores
+
+        flat_beam_ids = tf.reshape(flat_beam_ids, [-1])
+        states = [nest.map_structure(lambda state: tf.gather(state, flat_beam_ids), state) for state in new_states]
+
+        return (time + 1, mask, token_ids_array, parent_ids_array, batch_ids, final_scores, states, encoder_data,
+                max_lengths, token_ids, scores)
+
+    loop_vars = [time, mask, token_ids_array, parent_ids_array, batch_ids, final_scores, states, encoder_data,
+                 max_lengths, ids, scores]
+    shapes = nest.map_structure(shape_invariant, loop_vars)
 
     def cond(time, mask, *_):
         p1 = time < sequence_length
-        p2 = tf.to_int32(tf.reduce_sum(1 - mask)) < batch_size * beam_size
+        p2 = tf.reduce_any(mask > 0)   # some hypotheses have not ended yet
         return tf.logical_and(p1, p2)
 
-    _, mask, hypotheses, states, ids, scores = tf.while_loop(
+    _, _, token_ids_array, parent_ids_array, _, scores, _, _, _, _, _ = tf.while_loop(
         cond=cond,
         body=time_step,
         loop_vars=loop_vars,
@@ -231,7 +327,7 @@ def rnn_beam_search(update_funs, initial_states, sequence_length, beam_size, len
         parallel_iterations=parallel_iterations,
         swap_memory=swap_memory)
 
-    hypotheses = hypotheses[:, :, 1:]  # remove BOS symbol
+    hypotheses = backtrace(token_ids_array.stack(), parent_ids_array.stack())
 
     if len_normalization:
         n = tf.shape(hypotheses)[1]
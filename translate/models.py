@@ -367,29 +367,60 @@ def multi_encoder(encoder_inputs, encoders, encoder_input_length, other_inputs=N
     return encoder_outputs, encoder_state, new_encoder_input_length
 
 
-def compute_energy(hidden, state, encoder, time=None, input_length=None, prev_weights=None, **kwargs):
+def compute_attention_keys(hidden, encoder):
+    """
+    Projection of the encoder states used by `compute_energy`. It doesn't depend on the decoder state,
+    so it can be computed once per batch instead of at each decoder step (see `attention_decoder`).
+
+    :param hidden: encoder states, tensor of shape (batch_size, input_length, encoder_cell_size)
+    :return: tensor of shape (batch_size, input_length, attn_size)
+    """
+    if encoder.mult_attn:
+        return dense(hidden, encoder.attn_size, use_bias=False, name='hidden')
+
+    if encoder.layer_norm:
+        hidden = tf.contrib.layers.layer_norm(hidden, center=False, scope='layer_norm_hidden')
+
+    return dense(hidden, encoder.attn_size, use_bias=False, name='U_a')
+
+
+def compute_energy(hidden, state, encoder, time=None, input_length=None, prev_weights=None, keys=None, **kwargs):
+    """
+    :param keys: result of `compute_attention_keys` on `hidden` (computed here if None). With attention dropout,
+      these keys are only used when the keep probability is 1 (e.g., in decoding), otherwise the keys
+      are computed again on the encoder states with a new dropout mask.
+    """
     batch_size = tf.shape(hidden)[0]
     time_steps = tf.shape(hidden)[1]
 
+    def get_keys():
+        hidden_ = hidden
+        if encoder.attn_keep_prob is not None:
+            hidden_noise_shape = [1, 1, tf.shape(hidden)[2]] if encoder.pervasive_dropout else None
+            hidden_ = tf.nn.dropout(hidden, keep_prob=encoder.attn_keep_prob, noise_shape=hidden_noise_shape)
+        return compute_attention_keys(hidden_, encoder)
+
     if encoder.attn_keep_prob is not None:
         state_noise_shape = [1, tf.shape(state)[1]] if encoder.pervasive_dropout else None
         state = tf.nn.dropout(state, keep_prob=encoder.attn_keep_prob, noise_shape=state_noise_shape)
-        hidden_noise_shape = [1, 1, tf.shape(hidden)[2]] if encoder.pervasive_dropout else None
-        hidden = tf.nn.dropout(hidden, keep_prob=encoder.attn_keep_prob, noise_shape=hidden_noise_shape)
+
+    if keys is None:
+        keys = get_keys()
+    elif isinstance(encoder.attn_keep_prob, tf.Tensor):   # the dropout mask changes at each step
+        precomputed_keys = keys
+        keys = tf.cond(tf.equal(encoder.attn_keep_prob, 1.0), lambda: precomputed_keys, get_keys)
 
     if encoder.mult_attn:
         state = dense(state, encoder.attn_size, use_bias=False, name='state')
-        hidden = dense(hidden, encoder.attn_size, use_bias=False, name='hidden')
-        return tf.einsum('ijk,ik->ij', hidden, state)
+        return tf.einsum('ijk,ik->ij', keys, state)
 
     y = dense(state, encoder.attn_size, use_bias=not encoder.layer_norm, name='W_a')
     y = tf.expand_dims(y, axis=1)
 
     if encoder.layer_norm:
         y = tf.contrib.layers.layer_norm(y, scope='layer_norm_state')
-        hidden = tf.contrib.layers.layer_norm(hidden, center=False, scope='layer_norm_hidden')
 
-    y += dense(hidden, encoder.attn_size, use_bias=False, name='U_a')
+    y += keys
 
     if encoder.position_bias and input_length is not None and time is not None:
         src_pos = tf.tile(tf.expand_dims(tf.range(time_steps), axis=0), [batch_size, 1])
@@ -537,7 +568,7 @@ def local_attention(state, hidden_states, encoder, encoder_input_length, pos=Non
         return weighted_average, weights
 
 
-def attention(encoder, scope=None, **kwargs):
+def attention(encoder, scope=None, keys=None, **kwargs):
     attention_functions = {
         'global': global_attention,
         'local': local_attention,
@@ -555,7 +586,8 @@ def attention(encoder, scope=None, **kwargs):
     for i in range(attn_heads):
         scope_ = scope if i == 0 else scope + '_{}'.format(i + 1)
 
-        context_vector, weights_ = attention_function(encoder=encoder, scope=scope_, **kwargs)
+        keys_ = keys[i] if keys is not None else None
+        context_vector, weights_ = attention_function(encoder=encoder, scope=scope_, keys=keys_, **kwargs)
         context_vectors.append(context_vector)
         weights.append(weights_)
 
@@ -570,7 +602,11 @@ def attention(encoder, scope=None, **kwargs):
 
 
 def multi_attention(state, hidden_states, encoders, encoder_input_length, pos=None, aggregation_method='sum',
-                    prev_weights=None, **kwargs):
+                    prev_weights=None, attention_keys=None, **kwargs):
+    """
+    :param attention_keys: list of precomputed attention keys for each encoder (list of keys for each attention
+      head, or None)
+    """
     attns = []
     weights = []
 
@@ -578,13 +614,16 @@ def multi_attention(state, hidden_states, encoders, encoder_input_length, pos=No
     for i, (hidden, encoder, input_length) in enumerate(zip(hidden_states, encoders, encoder_input_length)):
         pos_ = pos[i] if pos is not None else None
         prev_weights_ = prev_weights[i] if prev_weights is not None else None
+        keys = attention_keys[i] if attention_keys is not None else None
 
         hidden = beam_search.resize_like(hidden, state)
         input_length = beam_search.resize_like(input_length, state)
+        if keys is not None:   # in beam-search decoding, the keys are shared by all the hypotheses of a beam
+            keys = [beam_search.resize_like(keys_, state) for keys_ in keys]
 
         context_vector, weights_ = attention(state=state, hidden_states=hidden, encoder=encoder,
                                              encoder_input_length=input_length, pos=pos_, context=context_vector,
-                                             prev_weights=prev_weights_, **kwargs)
+                                             prev_weights=prev_weights_, keys=keys, **kwargs)
         attns.append(context_vector)
         weights.append(weights_)
 
@@ -597,7 +636,8 @@ def multi_attention(state, hidden_states, encoders, encoder_input_length, pos=No
 
 
 def attention_decoder(decoder_inputs, initial_state, attention_states, encoders, decoder, encoder_input_length,
-                      feed_previous=0.0, align_encoder_id=0, feed_argmax=True, training=True, **kwargs):
+                      feed_previous=0.0, align_encoder_id=0, feed_argmax=True, training=True, sampled_softmax=None,
+                      shortlist=None, **kwargs):
     """
     :param decoder_inputs: int32 tensor of shape (batch_size, output_length)
     :param initial_state: initial state of the decoder (usually the final state of the encoder),
@@ -616,10 +656,15 @@ def attention_decoder(decoder_inputs, initial_state, attention_states, encoders,
     probability (argmax). When False, it samples a word from the probability distribution (softmax).
     :param align_encoder_id: outputs attention weights for this encoder. Also used when predicting edit operations
     (pred_edits), to specifify which encoder reads the sequence to post-edit (MT).
+    :param sampled_softmax: boolean tensor, when True (and `decoder.sampled_softmax` is set) the projection to
+      the vocabulary is skipped when feeding the ground truth, and the loss is given by `sampled_loss`
+    :param shortlist: int32 tensor of shape (shortlist_size,), ids of the output words to which the beam-search
+      decoder (`get_logits`) is restricted. Its logits are then over this shortlist, instead of the whole vocabulary.
 
     :return:
       outputs of the decoder as a tensor of shape (batch_size, output_length, decoder_cell_size)
       attention weights as a tensor of shape (output_length, encoders, batch_size, input_length)
+      sampled_loss: function which computes the sampled softmax loss (None if `decoder.sampled_softmax` is not set)
     """
 
     cell_output_size, cell_state_size = get_state_size(decoder.cell_type, decoder.cell_size,
@@ -696,7 +741,24 @@ def attention_decoder(decoder_inputs, initial_state, attention_states, encoders,
         else:
             return CellWrapper(MultiRNNCell(cells))
 
-    def look(time, state, input_, prev_weights=None, pos=None, context=None):
+    if decoder.hidden_state_scaling:
+        attention_states_ = [states * decoder.hidden_state_scaling for states in attention_states]
+    else:
+        attention_states_ = attention_states
+
+    def use_attention_keys(encoder_id, encoder):
+        if encoder.attention_type == 'local':   # `compute_energy` is only used by Luong's local attention
+            return encoder.attn_window_size > 0 and not (decoder.pred_edits and encoder_id == align_encoder_id)
+        else:
+            return encoder.attention_type not in ('none', 'average', 'last_state')
+
+    def look(time, state, input_, prev_weights=None, pos=None, context=None, encoder_data=None):
+        if encoder_data is not None:   # beam-search decoding, where the batch can shrink (see `get_logits`)
+            hidden_states, input_length, keys = encoder_data
+            keys = [keys_ or None for keys_ in keys]
+        else:
+            hidden_states, input_length, keys = attention_states_, encoder_input_length, attention_keys
+
         prev_weights_ = [prev_weights if i == align_encoder_id else None for i in range(len(encoders))]
         pos_ = None
         if decoder.pred_edits:
@@ -707,13 +769,9 @@ def attention_decoder(decoder_inputs, initial_state, attention_states, encoders,
         if decoder.attn_prev_attn and context is not None:
             state = tf.concat([state, context], axis=1)
 
-        if decoder.hidden_state_scaling:
-            attention_states_ = [states * decoder.hidden_state_scaling for states in attention_states]
-        else:
-            attention_states_ = attention_states
-
-        parameters = dict(hidden_states=attention_states_, encoder_input_length=encoder_input_length,
-                          encoders=encoders, aggregation_method=decoder.aggregation_method)
+        parameters = dict(hidden_states=hidden_states, encoder_input_length=input_length,
+                          encoders=encoders, aggregation_method=decoder.aggregation_method,
+                          attention_keys=keys)
         context, new_weights = multi_attention(state, time=time, pos=pos_, prev_weights=prev_weights_, **parameters)
 
         if decoder.context_mapping:
@@ -762,7 +820,7 @@ def attention_decoder(decoder_inputs, initial_state, attention_states, encoders,
             pos = tf.minimum(pos, tf.to_float(max_pos))
         return pos
 
-    def generate(state, input_, context):
+    def generate_input(state, input_, context):
         if decoder.pred_use_lstm_state is False:  # for back-compatibility
              state = state[:,-cell_output_size:]
 
@@ -770,8 +828,10 @@ def attention_decoder(decoder_inputs, initial_state, attention_states, encoders,
         if decoder.use_previous_word:
             projection_input.insert(1, input_)  # for back-compatibility
 
-        output_ = tf.concat(projection_input, axis=1)
+        return tf.concat(projection_input, axis=1)
 
+    def generate_hidden(output_):
+        """ Output layers of the decoder, before the projection to vocabulary size """
         if decoder.pred_deep_layer:
             deep_layer_size = decoder.pred_deep_layer_size or decoder.embedding_size
             if decoder.layer_norm:
@@ -801,13 +861,26 @@ def attention_decoder(decoder_inputs, initial_state, attention_states, encoders,
                 # to use the output embeddings for output projection (tie_embeddings parameter)
                 output_ = dense(output_, decoder.embedding_size, use_bias=False, name='softmax0')
 
+        return output_
+
+    def project(output_):
         if decoder.tie_embeddings and (decoder.pred_embed_proj or decoder.pred_deep_layer):
             bias = get_variable('softmax1/bias', shape=[decoder.vocab_size])
             output_ = tf.matmul(output_, tf.transpose(embedding)) + bias
+        elif decoder.sampled_softmax:
+            # same layout as the embeddings (vocab_size, hidden_size), so that `sampled_loss` only gathers
+            # (and updates) the rows of the sampled words
+            projection = get_variable('softmax1/projection',
+                                      shape=[decoder.vocab_size, output_.get_shape()[-1].value])
+            bias = get_variable('softmax1/bias', shape=[decoder.vocab_size], initializer=tf.zeros_initializer())
+            output_ = tf.matmul(output_, projection, transpose_b=True) + bias
         else:
             output_ = dense(output_, decoder.vocab_size, use_bias=True, name='softmax1')
         return output_
 
+    def generate(state, input_, context):
+        return project(generate_hidden(generate_input(state, input_, context)))
+
     if decoder.use_dropout:   # FIXME: why no pervasive dropout here?
         initial_state = tf.nn.dropout(initial_state, keep_prob=decoder.initial_state_keep_prob)
 
@@ -841,6 +914,13 @@ def attention_decoder(decoder_inputs, initial_state, attention_states, encoders,
     weights = tf.TensorArray(dtype=tf.float32, size=time_steps)
     attns = tf.TensorArray(dtype=tf.float32, size=time_steps)
 
+    # The output layers only need to run at each time step when the decoder's own predictions are fed back.
+    # Otherwise (teacher forcing), they are applied after the loop, on all the time steps at once.
+    per_step_output = tf.not_equal(feed_previous, 0.0)
+    output_inputs = tf.TensorArray(dtype=tf.float32, size=time_steps)
+    output_input_size = []   # static size of the inputs of the output layers (known when building the loop)
+    use_sampled_softmax = bool(decoder.sampled_softmax) and sampled_softmax is not None
+
     initial_symbol = inputs.read(0)  # first symbol is BOS
     initial_input = embed(initial_symbol)
     initial_pos = tf.zeros([batch_size], tf.float32)
@@ -848,21 +928,37 @@ def attention_decoder(decoder_inputs, initial_state, attention_states, encoders,
     zero_context = tf.zeros(shape=tf.shape(attention_states[align_encoder_id][:,0]))  # FIXME
 
     with tf.variable_scope('decoder_{}'.format(decoder.name)):
+        # the projection of the encoder states by the attention model is computed once per batch
+        # (instead of at each step), in the same variable scopes as `attention`
+        attention_keys = []
+        for i, encoder in enumerate(encoders):
+            if not use_attention_keys(i, encoder):
+                attention_keys.append(None)
+                continue
+            keys = []
+            scope = 'attention_{}'.format(encoder.name)
+            for j in range(encoder.attn_heads or 1):
+                with tf.variable_scope(scope if j == 0 else scope + '_{}'.format(j + 1)):
+                    keys.append(compute_attention_keys(attention_states_[i], encoder))
+            attention_keys.append(keys)
+
         initial_context, _ = look(0, initial_output, initial_input, pos=initial_pos, prev_weights=initial_weights,
                                   context=zero_context)
-    initial_data = tf.concat([initial_state, initial_context, tf.expand_dims(initial_pos, axis=1), initial_weights],
-                             axis=1)
-    context_size = initial_context.shape[1].value
+    # the beam-search state is a tuple (instead of one concatenated tensor), which avoids splitting and
+    # concatenating it at each step. It comes with the encoder outputs used at each step, of size (batch_size, ...),
+    # which the beam-search gives to `get_logits` (so that it can remove the finished sentences from the batch)
+    encoder_data = (attention_states_, encoder_input_length, [keys or [] for keys in attention_keys])
+    initial_data = ((initial_state, initial_context, initial_pos, initial_weights), encoder_data)
 
-    def get_logits(state, ids, time):  # for beam-search decoding
+    def get_logits(state, ids, time, encoder_data=None):  # for beam-search decoding
         with tf.variable_scope('decoder_{}'.format(decoder.name)):
-            state, context, pos, prev_weights = tf.split(state, [cell_state_size, context_size, 1, -1], axis=1)
+            state, context, pos, prev_weights = state
             input_ = embed(ids)
+            input_length = encoder_input_length if encoder_data is None else encoder_data[1]
 
-            pos = tf.squeeze(pos, axis=1)
             pos = tf.cond(tf.equal(time, 0),
                           lambda: pos,
-                          lambda: update_pos(pos, ids, encoder_input_length[align_encoder_id]))
+                          lambda: update_pos(pos, ids, input_length[align_encoder_id]))
 
             if decoder.cell_type.lower() == 'lstm' and decoder.use_lstm_full_state:
                 output = state
@@ -882,7 +978,8 @@ def attention_decoder(decoder_inputs, initial_state, attention_states, encoders,
                                         lambda: (output, state),
                                         lambda: update(state, input_, context, ids))
 
-            context, new_weights = look(time, output, input_, pos=pos, prev_weights=prev_weights, context=context)
+            context, new_weights = look(time, output, input_, pos=pos, prev_weights=prev_weights, context=context,
+                                        encoder_data=encoder_data)
 
             if decoder.conditional_rnn:
                 with tf.variable_scope('conditional_2'):
@@ -890,14 +987,16 @@ def attention_decoder(decoder_inputs, initial_state, attention_states, encoders,
             elif not decoder.generate_first:
                 output, state = update(state, input_, context, ids)
 
-            logits = generate(output, input_, context)
+            if shortlist is None:
+                logits = generate(output, input_, context)
+            else:
+                hidden = generate_hidden(generate_input(output, input_, context))
+                logits = tf.matmul(hidden, shortlist_weights) + shortlist_bias
 
-            pos = tf.expand_dims(pos, axis=1)
-            state = tf.concat([state, context, pos, new_weights], axis=1)
-            return state, logits
+            return (state, context, pos, new_weights), logits
 
     def _time_step(time, input_, input_symbol, pos, state, output, outputs, states, weights, attns, prev_weights,
-                   samples, context):
+                   samples, context, output_inputs):
         if decoder.conditional_rnn:
             with tf.variable_scope('conditional_1'):
                 output, state = update(state, input_)
@@ -912,7 +1011,13 @@ def attention_decoder(decoder_inputs, initial_state, attention_states, encoders,
         elif not decoder.generate_first:
             output, state = update(state, input_, context, input_symbol)
 
-        output_ = generate(output, input_, context)
+        output_input = generate_input(output, input_, context)
+        output_input_size[:] = [output_input.get_shape()[1].value]
+        output_inputs = output_inputs.write(time, output_input)
+        # empty logits with teacher forcing (computed after the loop)
+        output_ = tf.cond(per_step_output,
+                          lambda: project(generate_hidden(output_input)),
+                          lambda: tf.zeros(tf.stack([tf.shape(output_input)[0], 0])))
 
         argmax = lambda: tf.argmax(output_, 1)
         target = lambda: inputs.read(time + 1)
@@ -920,8 +1025,10 @@ def attention_decoder(decoder_inputs, initial_state, attention_states, encoders,
                                      axis=1)
 
         use_target = tf.logical_and(time < time_steps - 1, tf.random_uniform([]) >= feed_previous)
+        no_logits = lambda: tf.zeros(tf.shape(input_symbol), dtype=tf.int64)  # last step with teacher forcing
         predicted_symbol = tf.case([
             (use_target, target),
+            (tf.logical_not(per_step_output), no_logits),
             (tf.logical_not(feed_argmax), softmax)],
             default=argmax)   # default case is useful for beam-search
 
@@ -941,16 +1048,18 @@ def attention_decoder(decoder_inputs, initial_state, attention_states, encoders,
             output, state = update(state, input_, context, predicted_symbol)
 
         return (time + 1, input_, predicted_symbol, pos, state, output, outputs, states, weights, attns, new_weights,
-                samples, context)
+                samples, context, output_inputs)
 
     with tf.variable_scope('decoder_{}'.format(decoder.name)):
-        _, _, _, new_pos, new_state, _, outputs, states, weights, attns, new_weights, samples, _ = tf.while_loop(
+        loop_outputs = tf.while_loop(
             cond=lambda time, *_: time < time_steps,
             body=_time_step,
             loop_vars=(time, initial_input, initial_symbol, initial_pos, initial_state, initial_output, outputs,
-                       weights, states, attns, initial_weights, samples, initial_context),
+                       weights, states, attns, initial_weights, samples, initial_context, output_inputs),
             parallel_iterations=decoder.parallel_iterations,
             swap_memory=decoder.swap_memory)
+        (_, _, _, new_pos, new_state, _, outputs, states, weights, attns, new_weights, samples, _,
+         output_inputs) = loop_outputs
 
     outputs = outputs.stack()
     weights = weights.stack()  # batch_size, encoders, output time, input time
@@ -965,12 +1074,72 @@ def attention_decoder(decoder_inputs, initial_state, attention_states, encoders,
     attns = tf.transpose(attns, perm=(1, 0, 2))
     samples = tf.transpose(samples)
 
-    return outputs, weights, states, attns, samples, get_logits, initial_data
+    # inputs of the output layers for all time steps, as a tensor of shape (batch_size * output_length, input_size)
+    output_inputs = tf.reshape(tf.transpose(output_inputs.stack(), perm=(1, 0, 2)), shape=[-1, output_input_size[0]])
+
+    def get_hidden():
+        with tf.variable_scope('decoder_{}'.format(decoder.name)):
+            return generate_hidden(output_inputs)
+
+    def get_outputs():
+        hidden = get_hidden()
+        with tf.variable_scope('decoder_{}'.format(decoder.name)):
+            output_ = project(hidden)
+        return tf.reshape(output_, shape=tf.stack([batch_size, time_steps, decoder.vocab_size]))
+
+    if use_sampled_softmax:
+        # no logits in training updates (see `sampled_loss`)
+        no_outputs = lambda: tf.zeros(tf.stack([batch_size, time_steps, 0]))
+        teacher_forcing_outputs = lambda: tf.cond(sampled_softmax, no_outputs, get_outputs)
+    else:
+        teacher_forcing_outputs = get_outputs
+
+    per_step_outputs = outputs
+    outputs = tf.cond(per_step_output, lambda: per_step_outputs, teacher_forcing_outputs)
+    outputs.set_shape([None, None, decoder.vocab_size])
+
+    def get_projection():
+        """ Parameters of the projection to vocabulary size (`softmax1` or the tied embeddings) """
+        with tf.variable_scope('decoder_{}'.format(decoder.name)):
+            bias = get_variable('softmax1/bias', shape=[decoder.vocab_size])
+            if decoder.tie_embeddings and (decoder.pred_embed_proj or decoder.pred_deep_layer):
+                projection = embedding
+            elif decoder.sampled_softmax:   # created by `project`
+                projection = get_variable('softmax1/projection')
+            else:
+                projection = tf.transpose(get_variable('softmax1/kernel'))
+        return projection, bias   # (vocab_size, hidden_size) and (vocab_size,)
+
+    if shortlist is not None:
+        # `get_logits` is called in the beam-search loop, but the shortlisted parameters are gathered only once
+        projection, bias = get_projection()
+        shortlist_weights = tf.transpose(tf.gather(projection, shortlist))
+        shortlist_bias = tf.gather(bias, shortlist)
+
+    if not use_sampled_softmax:
+        return outputs, weights, states, attns, samples, get_logits, initial_data, None
+
+    def sampled_loss(targets, target_weights):
+        """
+        Sampled softmax approximation of `sequence_loss` (training only, with teacher forcing), which uses the
+        same output projection (`softmax1` or the tied embeddings).
+        """
+        hidden = get_hidden()
+        projection, bias = get_projection()
+
+        crossent = tf.nn.sampled_softmax_loss(weights=projection, biases=bias,
+                                              labels=tf.reshape(tf.to_int64(targets), shape=[-1, 1]),
+                                              inputs=hidden, num_sampled=decoder.sampled_softmax,
+                                              num_classes=decoder.vocab_size)
+        crossent = tf.reshape(crossent, tf.shape(targets))
+        return tf.reduce_sum(crossent * target_weights) / tf.to_float(tf.shape(targets)[0])
+
+    return outputs, weights, states, attns, samples, get_logits, initial_data, sampled_loss
 
 
 def encoder_decoder(encoders, decoders, encoder_inputs, targets, feed_previous, align_encoder_id=0,
                     encoder_input_length=None, feed_argmax=True, rewards=None, use_baseline=True,
-                    training=True, global_step=None,
+                    training=True, global_step=None, sampled_softmax=None, shortlist=None,
                     monotonicity_weight=None, monotonicity_dist=None, monotonicity_decay=None, **kwargs):
     decoder = decoders[0]
     targets = targets[0]  # single decoder
@@ -987,10 +1156,10 @@ def encoder_decoder(encoders, decoders, encoder_inputs, targets, feed_previous,
     attention_states, encoder_state, encoder_input_length = multi_encoder(
         encoder_input_length=encoder_input_length, **parameters)
 
-    outputs, attention_weights, _, _, samples, beam_fun, initial_data = attention_decoder(
+    outputs, attention_weights, _, _, samples, beam_fun, initial_data, sampled_loss = attention_decoder(
         attention_states=attention_states, initial_state=encoder_state, feed_previous=feed_previous,
         decoder_inputs=targets[:, :-1], align_encoder_id=align_encoder_id, encoder_input_length=encoder_input_length,
-        **parameters
+        sampled_softmax=sampled_softmax, shortlist=shortlist, **parameters
     )
 
     if use_baseline:
@@ -1006,7 +1175,13 @@ def encoder_decoder(encoders, decoders, encoder_inputs, targets, feed_previous,
                                    rewards=baseline_rewards)
 
     trg_mask = get_weights(targets[:, 1:], utils.EOS_ID, include_first_eos=True)
-    xent_loss = sequence_loss(logits=outputs, targets=targets[:, 1:], weights=trg_mask)
+    if sampled_loss is None:
+        xent_loss = sequence_loss(logits=outputs, targets=targets[:, 1:], weights=trg_mask)
+    else:
+        # the sampled softmax is only used by training updates (the dev loss uses the full softmax)
+        xent_loss = tf.cond(sampled_softmax,
+                            lambda: sampled_loss(targets=targets[:, 1:], target_weights=trg_mask),
+                            lambda: sequence_loss(logits=outputs, targets=targets[:, 1:], weights=trg_mask))
 
     if monotonicity_weight:
         monotonicity_dist = monotonicity_dist or 1.0
@@ -1046,7 +1221,7 @@ def encoder_decoder(encoders, decoders, encoder_inputs, targets, feed_previous,
 
 def reconstruction_encoder_decoder(encoders, decoders, encoder_inputs, targets, feed_previous,
                                    encoder_input_length=None, training=True, reconstruction_weight=1.0,
-                                   reconstruction_attn_weight=0.05, **kwargs):
+                                   reconstruction_attn_weight=0.05, shortlist=None, **kwargs):
     encoders = encoders[:1]
 
     if encoder_input_length is None:
@@ -1057,10 +1232,10 @@ def reconstruction_encoder_decoder(encoders, decoders, encoder_inputs, targets,
         encoder_input_length=encoder_input_length, encoders=encoders, encoder_inputs=encoder_inputs,
         training=training)
 
-    outputs, attention_weights, states, _, samples, beam_fun, initial_data = attention_decoder(
+    outputs, attention_weights, states, _, samples, beam_fun, initial_data, _ = attention_decoder(
         attention_states=attention_states, initial_state=encoder_state, feed_previous=feed_previous,
         decoder_inputs=targets[0][:, :-1], encoder_input_length=encoder_input_length,
-        decoder=decoders[0], training=training, encoders=encoders
+        decoder=decoders[0], training=training, encoders=encoders, shortlist=shortlist
     )
 
     target_weights = get_weights(targets[0][:, 1:], utils.EOS_ID, include_first_eos=True)
@@ -1068,7 +1243,7 @@ def reconstruction_encoder_decoder(encoders, decoders, encoder_inputs, targets,
 
     xent_loss = sequence_loss(logits=outputs, targets=targets[0][:, 1:], weights=target_weights)
 
-    reconstructed_outputs, reconstructed_weights, _, _, _, _, _ = attention_decoder(
+    reconstructed_outputs, reconstructed_weights, _, _, _, _, _, _ = attention_decoder(
         attention_states=[states], initial_state=states[:,-1,:], feed_previous=feed_previous,
         decoder_inputs=targets[1][:, :-1], encoder_input_length=target_length,
         decoder=decoders[1], training=training, encoders=decoders[:1]
@@ -1097,7 +1272,8 @@ def reconstruction_encoder_decoder(encoders, decoders, encoder_inputs, targets,
 
 def chained_encoder_decoder(encoders, decoders, encoder_inputs, targets, feed_previous,
                             chaining_strategy=None, align_encoder_id=0, chaining_non_linearity=False,
-                            chaining_loss_ratio=1.0, chaining_stop_gradient=False, training=True, **kwargs):
+                            chaining_loss_ratio=1.0, chaining_stop_gradient=False, training=True, shortlist=None,
+                            **kwargs):
     decoder = decoders[0]
     targets = targets[0]  # single decoder
 
@@ -1123,7 +1299,7 @@ def chained_encoder_decoder(encoders, decoders, encoder_inputs, targets, feed_pr
     pad = tf.ones(shape=tf.stack([batch_size, 1]), dtype=tf.int32) * utils.BOS_ID
     decoder_inputs = tf.concat([pad, decoder_inputs], axis=1)
 
-    outputs, attention_weights_1, states, attns, _, _, _ = attention_decoder(
+    outputs, attention_weights_1, states, attns, _, _, _, _ = attention_decoder(
         attention_states=attention_states, initial_state=encoder_state, decoder_inputs=decoder_inputs,
         encoder_input_length=encoder_input_length[1:], **parameters
     )
@@ -1182,10 +1358,10 @@ def chained_encoder_decoder(encoders, decoders, encoder_inputs, targets, feed_pr
 
         attention_states[0] += x
 
-    outputs, attention_weights_2, _, _, samples, beam_fun, initial_data = attention_decoder(
+    outputs, attention_weights_2, _, _, samples, beam_fun, initial_data, _ = attention_decoder(
         attention_states=attention_states, initial_state=encoder_state,
         feed_previous=feed_previous, decoder_inputs=targets[:,:-1],
-        align_encoder_id=0, encoder_input_length=encoder_input_length[:1],
+        align_encoder_id=0, encoder_input_length=encoder_input_length[:1], shortlist=shortlist,
         **parameters
     )
 
@@ -1208,7 +1384,7 @@ def chained_encoder_decoder(encoders, decoders, encoder_inputs, targets, feed_pr
 
 
 def multi_task_encoder_decoder(encoders, decoders, encoder_inputs, targets, feed_previous, encoder_input_length=None,
-                               feed_argmax=True, training=True, task_ratios=None, **kwargs):
+                               feed_argmax=True, training=True, task_ratios=None, shortlist=None, **kwargs):
     if encoder_input_length is None:
         encoder_input_length = []
         for encoder_inputs_ in encoder_inputs:
@@ -1244,10 +1420,10 @@ def multi_task_encoder_decoder(encoders, decoders, encoder_inputs, targets, feed
         attention_states_, encoder_state_, encoder_input_length_ = multi_encoder(
             encoder_input_length=encoder_input_length_, **parameters)
 
-        outputs_, attention_weights_, _, _, samples_, beam_fun_, initial_data_ = attention_decoder(
+        outputs_, attention_weights_, _, _, samples_, beam_fun_, initial_data_, _ = attention_decoder(
             attention_states=attention_states_, initial_state=encoder_state_, feed_previous=feed_previous,
             decoder_inputs=targets_[:, :-1], align_encoder_id=0, encoder_input_length=encoder_input_length_,
-            **parameters
+            shortlist=shortlist, **parameters
         )
 
         trg_mask = get_weights(targets_[:, 1:], utils.EOS_ID, include_first_eos=True)
@@ -36,18 +36,17 @@ class MultiTaskModel:
                 model.train_step(**kwargs)
             except (utils.FinishedTrainingException, KeyboardInterrupt):
                 utils.log('exiting...')
-                self.main_model.save()
+                self.save()
+                self.wait_for_save()
                 return
             except utils.EvalException:
                 if i == 0:
-                    model.save()
-                    step, score = model.training.scores[-1]
-                    model.manage_best_checkpoints(step, score)
+                    self.save()
+                    model.run_after_save(model.manage_eval)
             except utils.CheckpointException:
                 if i == 0:   # only save main model (includes all variables)
-                    model.save()
-                    step, score = model.training.scores[-1]
-                    model.manage_best_checkpoints(step, score)
+                    self.save()
+                    model.run_after_save(model.manage_eval)
 
     def decode(self, *args, **kwargs):
         self.main_model.decode(*args, **kwargs)
@@ -55,11 +54,19 @@ class MultiTaskModel:
     def evaluate(self, *args, **kwargs):
         return self.main_model.evaluate(*args, **kwargs)
 
+    def eval_worker(self, *args, **kwargs):
+        self.main_model.eval_worker(*args, **kwargs)
+
     def align(self, *args, **kwargs):
         self.main_model.align(*args, **kwargs)
 
     def initialize(self, *args, **kwargs):
         self.main_model.initialize(*args, **kwargs)
 
+    def wait_for_save(self):
+        self.main_model.wait_for_save()
+
     def save(self, *args, **kwargs):
         self.main_model.save(*args, **kwargs)
+        for model in self.models[1:]:   # the main checkpoint contains all the tasks' variables
+            model.save_batch_state()
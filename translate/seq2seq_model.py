@@ -15,7 +15,8 @@ class Seq2SeqModel(object):
                  freeze_variables=None, feed_previous=0.0, optimizer='sgd', decode_only=False,
                  len_normalization=1.0, name=None, chained_encoders=False, baseline_step=None,
                  use_baseline=True, reverse_input=False, reconstruction_decoders=False, multi_task=False,
-                 **kwargs):
+                 tf_data_prefetch=False, replicas=1, task_index=0, accumulate_steps=1, shrink_beam_batch=False,
+                 shortlist=None, **kwargs):
         self.encoders = encoders
         self.decoders = decoders
         self.temperature = self.decoders[0].temperature
@@ -31,10 +32,23 @@ class Seq2SeqModel(object):
         self.max_output_len = [decoder.max_len for decoder in decoders]
         self.max_input_len = [encoder.max_len for encoder in encoders]
         self.len_normalization = len_normalization
+        self.shrink_beam_batch = shrink_beam_batch
         self.reverse_input = reverse_input
 
-        dropout_on = []
-        dropout_off = []
+        # gradients of several consecutive batches can be accumulated, and applied all at once
+        self.accumulate_steps = accumulate_steps or 1
+        self.accumulated_steps = 0
+        # in data-parallel training, the accumulation buffers are local to each worker
+        self.worker_device = '/job:worker/task:{}'.format(task_index) if replicas > 1 else ''
+
+        # parameters of `get_batch` (plain Python values, which can be sent to other processes)
+        self.batch_params = dict(binary=[bool(encoder.binary) for encoder in encoders],
+                                 embedding_size=[encoder.embedding_size for encoder in encoders],
+                                 max_input_len=self.max_input_len, max_output_len=self.max_output_len,
+                                 reverse_input=reverse_input)
+
+        # keep probabilities default to 1 (no dropout), and are fed with their training value in training steps
+        self.dropout_feed = {}
 
         if use_dropout:
             for encoder_or_decoder in encoders + decoders:
@@ -47,34 +61,54 @@ class Seq2SeqModel(object):
                     if not value:
                         encoder_or_decoder[var_name] = 1.0
                         continue
-                    var = tf.Variable(1 - value, trainable=False, name=var_name)
+                    var = tf.placeholder_with_default(1.0, shape=(), name=var_name)
                     encoder_or_decoder[var_name] = var
-                    dropout_on.append(var.assign(1.0 - value))
-                    dropout_off.append(var.assign(1.0))
-
-        self.dropout_on = tf.group(*dropout_on)
-        self.dropout_off = tf.group(*dropout_off)
+                    self.dropout_feed[var] = 1.0 - value
 
         self.feed_previous = tf.constant(feed_previous, dtype=tf.float32)
         self.feed_argmax = tf.constant(True, dtype=tf.bool)  # feed with argmax or sample from softmax
         self.training = tf.placeholder(dtype=tf.bool, shape=())
+        # sampled softmax loss (with `sampled_softmax`) in training updates, full softmax otherwise
+        self.sampled_softmax = tf.placeholder_with_default(False, shape=(), name='sampled_softmax')
+        # output words to which beam-search decoding is restricted (with a `shortlist` lexicon), fed for each batch
+        if shortlist:
+            vocab = tf.range(decoders[0].vocab_size)
+            self.shortlist = tf.placeholder_with_default(vocab, shape=[None], name='shortlist')
+        else:
+            self.shortlist = None
+
+        # shapes and types of the inputs: encoder inputs, encoder input lengths, targets
+        input_shapes = ([[None, None, encoder.embedding_size] if encoder.binary else [None, None]
+                         for encoder in encoders] + [[None] for _ in encoders] + [[None, None] for _ in decoders])
+        input_types = ([tf.float32 if encoder.binary else tf.int32 for encoder in encoders] +
+                       [tf.int32 for _ in encoders] + [tf.int32 for _ in decoders])
+        input_names = (['encoder_{}'.format(encoder.name) for encoder in encoders] +
+                       ['encoder_input_length_{}'.format(encoder.name) for encoder in encoders] +
+                       ['target_{}'.format(decoder.name) for decoder in decoders])
+
+        if tf_data_prefetch:
+            # training batches come from a tf.data pipeline (on top of the Python batch iterator), which is
+            # prefetched by a TensorFlow thread. The placeholders default to the next element of this pipeline,
+            # but can still be fed
+            # (e.g., for decoding and for computing the dev loss)
+            self.pipeline_generator = None   # set by `TranslationModel.init_training`
+            dataset = tf.data.Dataset.from_generator(lambda: self.pipeline_generator(),
+                                                     output_types=tuple(input_types),
+                                                     output_shapes=tuple(map(tf.TensorShape, input_shapes)))
+            self.pipeline = dataset.prefetch(1).make_initializable_iterator()
+            next_element = self.pipeline.get_next()
+            placeholders = [tf.placeholder_with_default(default, shape=shape, name=name)
+                            for default, shape, name in zip(next_element, input_shapes, input_names)]
+        else:
+            self.pipeline = None
+            placeholders = [tf.placeholder(dtype=dtype, shape=shape, name=name)
+                            for dtype, shape, name in zip(input_types, input_shapes, input_names)]
 
-        self.encoder_inputs = []
-        self.encoder_input_length = []
-        for encoder in encoders:
-            shape = [None, None, encoder.embedding_size] if encoder.binary else [None, None]
-            dtype = tf.float32 if encoder.binary else tf.int32
-            encoder_input = tf.placeholder(dtype=dtype, shape=shape, name='encoder_{}'.format(encoder.name))
-            encoder_input_length = tf.placeholder(dtype=tf.int32, shape=[None],
-                                                  name='encoder_input_length_{}'.format(encoder.name))
-            self.encoder_inputs.append(encoder_input)
-            self.encoder_input_length.append(encoder_input_length)
-
+        encoder_count = len(encoders)
+        self.encoder_inputs = placeholders[:encoder_count]
+        self.encoder_input_length = placeholders[encoder_count:2 * encoder_count]
         # starts with BOS, and ends with EOS
-        self.targets = tuple([
-            tf.placeholder(tf.int32, shape=[None, None], name='target_{}'.format(decoder.name))
-            for decoder in decoders
-        ])
+        self.targets = tuple(placeholders[2 * encoder_count:])
         self.rewards = tf.placeholder(tf.float32, shape=[None, None], name='rewards')
 
         if reconstruction_decoders:
@@ -89,7 +123,8 @@ class Seq2SeqModel(object):
         tensors = architecture(encoders, decoders, self.encoder_inputs, self.targets, self.feed_previous,
                                encoder_input_length=self.encoder_input_length, feed_argmax=self.feed_argmax,
                                rewards=self.rewards, use_baseline=use_baseline, training=self.training,
-                               global_step=self.global_step, **kwargs)
+                               global_step=self.global_step, sampled_softmax=self.sampled_softmax,
+                               shortlist=self.shortlist, **kwargs)
 
         self.losses, self.outputs, self.attention_weights, self.samples, self.beam_fun, self.initial_data = tensors
 
@@ -98,32 +133,69 @@ class Seq2SeqModel(object):
 
         optimizers = self.get_optimizers(optimizer, learning_rate)
 
+        # hooks which initialize the synchronous data-parallel training (see `TranslationModel.initialize`)
+        self.sync_hooks = []
+
+        if not decode_only and replicas > 1:
+            # synchronous data-parallel training: the gradients of all the workers are averaged, before being
+            # applied once. The accumulators are shared by all the optimizers of the same variables, so only
+            # the main optimizer and loss are supported.
+            optimizers = [tf.train.SyncReplicasOptimizer(optimizers[0], replicas_to_aggregate=replicas,
+                                                         total_num_replicas=replicas)]
+
         if not decode_only:
             get_update_ops = functools.partial(self.get_update_op, opts=optimizers,
                                                max_gradient_norm=max_gradient_norm, freeze_variables=freeze_variables)
 
-            self.update_ops = utils.AttrDict({
-                'xent': get_update_ops(self.xent_loss, global_step=self.global_step),
-                'reinforce': get_update_ops(self.reinforce_loss, global_step=self.global_step),
-            })
+            # with `accumulate_steps`, the update ops only apply the gradients every `accumulate_steps` batches,
+            # and the accumulate ops add up the gradients of the other batches
+            self.update_ops = utils.AttrDict()
+            self.accumulate_ops = utils.AttrDict()
+
+            self.update_ops.xent, self.accumulate_ops.xent = get_update_ops(self.xent_loss,
+                                                                            global_step=self.global_step)
+
+            if replicas == 1:
+                self.update_ops.reinforce, self.accumulate_ops.reinforce = get_update_ops(
+                    self.reinforce_loss, global_step=self.global_step)
+
+            if use_baseline and replicas == 1:
+                # the baseline is also updated during its pre-training (without any main update), so it is
+                # always updated after each batch
+                self.update_ops.baseline, _ = get_update_ops(self.baseline_loss, global_step=self.baseline_step,
+                                                             accumulate_steps=1)
 
-            if use_baseline:
-                self.update_ops['baseline'] = get_update_ops(self.baseline_loss, global_step=self.baseline_step)
+            if replicas > 1:
+                self.sync_hooks = [opt.make_session_run_hook(is_chief=task_index == 0) for opt in optimizers]
+                for hook in self.sync_hooks:
+                    hook.begin()
 
         self.models = [self]
         self.beam_outputs = tf.expand_dims(tf.argmax(self.outputs[0], axis=2), axis=1)
         self.beam_scores = tf.zeros(shape=[tf.shape(self.beam_outputs)[0], 1])
         self.beam_size = tf.placeholder(shape=(), dtype=tf.int32)
 
-    def create_beam_op(self, models, len_normalization):
+    def create_beam_op(self, models, len_normalization, max_len_ratio=None, max_len_offset=0):
+        """
+        :param max_len_ratio: if not None, limit the output length of each sentence to
+          `max_len_ratio * input_length + max_len_offset` (where the input length is that of the first encoder)
+        """
         self.len_normalization = len_normalization
         self.models = models
         beam_funs = [model.beam_fun for model in models]
         initial_data = [model.initial_data for model in models]
-        beam_output = beam_search.rnn_beam_search(beam_funs, initial_data, self.max_output_len[0], self.beam_size,
+
+        max_output_len = self.max_output_len[0]
+        if max_len_ratio is not None:
+            input_length = tf.to_float(self.encoder_input_length[0])
+            max_output_len_ = tf.to_int32(tf.ceil(max_len_ratio * input_length + (max_len_offset or 0)))
+            max_output_len = tf.minimum(max_output_len_, max_output_len)
+
+        beam_output = beam_search.rnn_beam_search(beam_funs, initial_data, max_output_len, self.beam_size,
                                                   len_normalization, temperature=self.temperature,
                                                   parallel_iterations=self.decoders[0].parallel_iterations,
-                                                  swap_memory=self.decoders[0].swap_memory)
+                                                  swap_memory=self.decoders[0].swap_memory,
+                                                  shrink_batch=self.shrink_beam_batch, output_ids=self.shortlist)
         self.beam_outputs, self.beam_scores = beam_output
 
     @staticmethod
@@ -140,9 +212,16 @@ class Seq2SeqModel(object):
 
         return opt, sgd_opt
 
-    def get_update_op(self, loss, opts, global_step=None, max_gradient_norm=None, freeze_variables=None):
+    def get_update_op(self, loss, opts, global_step=None, max_gradient_norm=None, freeze_variables=None,
+                      accumulate_steps=None):
+        """
+        :return: list of update ops (one per optimizer), and accumulate op (None if there is no
+          gradient accumulation)
+        """
         if loss is None:
-            return None
+            return None, None
+
+        accumulate_steps = accumulate_steps or self.accumulate_steps
 
         freeze_variables = freeze_variables or []
 
@@ -157,6 +236,40 @@ class Seq2SeqModel(object):
         # from translate.memory_saving_gradients import gradients as mem_save_gradients
         # gradients = mem_save_gradients(loss, params, checkpoints='speed')  # try 'memory'
 
+        accumulate_op = None
+        reset_op = None
+        if accumulate_steps > 1:
+            # the gradients are summed into local (non-saved) buffers. The last batch is accumulated by the
+            # update op itself, which then applies the average gradient and resets the buffers.
+            accumulate_ops = []
+            buffers = []
+            with tf.device(self.worker_device), tf.variable_scope('gradients' if self.name is None else
+                                                                  'gradients_{}'.format(self.name)):
+                for param, gradient in zip(params, gradients):
+                    if gradient is None:
+                        buffers.append(None)
+                        continue
+                    buffer = tf.Variable(tf.zeros(param.get_shape(), dtype=param.dtype.base_dtype),
+                                         trainable=False, collections=[tf.GraphKeys.LOCAL_VARIABLES],
+                                         name='accumulate')
+                    if isinstance(gradient, tf.IndexedSlices):   # embeddings
+                        accumulate_ops.append(tf.scatter_add(buffer, gradient.indices, gradient.values))
+                    else:
+                        accumulate_ops.append(buffer.assign_add(gradient))
+                    buffers.append(buffer)
+
+                accumulate_op = tf.group(*accumulate_ops)
+                with tf.control_dependencies([accumulate_op]):
+                    gradients = [None if buffer is None else buffer.read_value() / accumulate_steps
+                                 for buffer in buffers]
+                reset_op = tf.group(*[buffer.assign(tf.zeros_like(buffer)) for buffer in buffers
+                                      if buffer is not None])
+
+            if global_step is not None:
+                with tf.control_dependencies([accumulate_op]):
+                    accumulate_op = tf.identity(global_step)
+
+        # clipping is done on the average gradient (like with a single large batch)
         if max_gradient_norm:
             gradients, _ = tf.clip_by_global_norm(gradients, max_gradient_norm)
 
@@ -167,15 +280,39 @@ class Seq2SeqModel(object):
                 with tf.control_dependencies(update_ops_):  # update batch_norm's moving averages
                     update_op = opt.apply_gradients(list(zip(gradients, params)), global_step=global_step)
 
+                if reset_op is not None:
+                    with tf.control_dependencies([update_op]):
+                        update_op = tf.group(reset_op)
+
+                if global_step is not None:
+                    # running the update returns the new value of the global step (saves a separate call)
+                    with tf.control_dependencies([update_op]):
+                        update_op = tf.identity(global_step)
+
             update_ops.append(update_op)
 
-        return update_ops
+        return update_ops, accumulate_op
+
+    def get_training_op(self, loss_name, use_sgd=False):
+        """
+        Op to run for this training batch: update op every `accumulate_steps` batches, accumulate op otherwise.
+
+        :param loss_name: 'xent' or 'reinforce'
+        :param use_sgd: use the SGD optimizer instead of the main optimizer
+        """
+        self.accumulated_steps = (self.accumulated_steps + 1) % self.accumulate_steps
+        if self.accumulated_steps == 0:
+            return self.update_ops[loss_name][1 if use_sgd else 0]
+        else:
+            return self.accumulate_ops[loss_name]
 
     def reinforce_step(self, data, update_model=True, align=False, use_sgd=False, update_baseline=True,
-                       reward_function=None, **kwargs):
+                       reward_function=None, batch=None, **kwargs):
         # self.dropout_on.run()
 
-        encoder_inputs, targets, input_length = self.get_batch(data)
+        if batch is None:  # batch can be prepared in advance (see `utils.prefetch_iterator`)
+            batch = self.get_batch(data)
+        encoder_inputs, targets, input_length = batch
         input_feed = {self.targets: targets, self.feed_argmax: False, self.feed_previous: 1.0, self.training: True}
 
         for i in range(len(self.encoders)):
@@ -209,9 +346,10 @@ class Seq2SeqModel(object):
         input_feed[self.samples] = samples
         input_feed[self.rewards] = rewards
 
-        output_feed = {'loss': self.reinforce_loss, 'baseline_loss': self.baseline_loss}
+        output_feed = {'loss': self.reinforce_loss, 'baseline_loss': self.baseline_loss,
+                       'learning_rate': self.learning_rate}
         if update_model:
-            output_feed['update'] = self.update_ops.reinforce[1] if use_sgd else self.update_ops.reinforce[0]
+            output_feed['update'] = self.get_training_op('reinforce', use_sgd=use_sgd)
         if self.use_baseline and update_baseline:
             output_feed['baseline_update'] = self.update_ops.baseline[0]  # FIXME
 
@@ -219,35 +357,45 @@ class Seq2SeqModel(object):
             output_feed['weights'] = self.attention_weights
 
         res = tf.get_default_session().run(output_feed, input_feed)
-        return namedtuple('output', 'loss weights baseline_loss')(res['loss'], res.get('weights'),
-                                                                  res.get('baseline_loss'))
+        return namedtuple('output', 'loss weights baseline_loss global_step learning_rate')(
+            res['loss'], res.get('weights'), res.get('baseline_loss'), res.get('update'), res['learning_rate'])
 
-    def step(self, data, update_model=True, align=False, use_sgd=False, **kwargs):
-        if update_model:
-            self.dropout_on.run()
-        else:
-            self.dropout_off.run()
+    def step(self, data=None, update_model=True, align=False, use_sgd=False, batch=None, **kwargs):
+        """
+        Training step (or loss computation if `update_model` is False), in a single `session.run` call.
 
-        encoder_inputs, targets, input_length = self.get_batch(data)
-        input_feed = {self.targets: targets, self.training: True}
+        If `data` and `batch` are None, the next batch is taken from the input pipeline (see `tf_data_prefetch`).
 
-        for i in range(len(self.encoders)):
-            input_feed[self.encoder_inputs[i]] = encoder_inputs[i]
-            input_feed[self.encoder_input_length[i]] = input_length[i]
+        :return: namedtuple containing the loss, the attention weights (if `align` is True),
+          and the global step (after the update) and learning rate (if `update_model` is True)
+        """
+        if batch is None and data is not None:  # batch can be prepared in advance (see `utils.prefetch_iterator`)
+            batch = self.get_batch(data)
+
+        input_feed = {self.training: True}
+        if update_model:
+            input_feed.update(self.dropout_feed)
+            input_feed[self.sampled_softmax] = True
+
+        if batch is not None:
+            encoder_inputs, targets, input_length = batch
+            input_feed[self.targets] = targets
+            for i in range(len(self.encoders)):
+                input_feed[self.encoder_inputs[i]] = encoder_inputs[i]
+                input_feed[self.encoder_input_length[i]] = input_length[i]
 
         output_feed = {'loss': self.xent_loss}
         if update_model:
-            output_feed['update'] = self.update_ops.xent[1] if use_sgd else self.update_ops.xent[0]
+            output_feed['update'] = self.get_training_op('xent', use_sgd=use_sgd)
+            output_feed['learning_rate'] = self.learning_rate
         if align:
             output_feed['weights'] = self.attention_weights
 
         res = tf.get_default_session().run(output_feed, input_feed)
-        return namedtuple('output', 'loss weights')(res['loss'], res.get('weights'))
-
-    def greedy_decoding(self, token_ids, align=False, beam_size=1):
-        for model in self.models:
-            model.dropout_off.run()
+        return namedtuple('output', 'loss weights global_step learning_rate')(
+            res['loss'], res.get('weights'), res.get('update'), res.get('learning_rate'))
 
+    def greedy_decoding(self, token_ids, align=False, beam_size=1, shortlist=None):
         data = [
             ids + [[] for _ in self.decoders] if len(ids) == len(self.encoders) else ids
             for ids in token_ids
@@ -264,6 +412,8 @@ class Seq2SeqModel(object):
             for i in range(len(model.encoders)):
                 input_feed[model.encoder_inputs[i]] = encoder_inputs[i]
                 input_feed[model.encoder_input_length[i]] = input_length[i]
+            if shortlist is not None and model.shortlist is not None:
+                input_feed[model.shortlist] = shortlist
 
         output_feed = {'outputs': self.beam_outputs}
         if align:
@@ -279,57 +429,80 @@ class Seq2SeqModel(object):
           data for the decoder side (using the maximum output size)
         :return:
         """
-        inputs = [[] for _ in self.encoders]
-        targets = [[] for _ in self.decoders]
-        input_length = [[] for _ in self.encoders]
-
-        # maximum input length of each encoder in this batch
-        max_input_len = [max(len(data_[i]) for data_ in data) for i in range(len(self.encoders))]
-
-        if self.max_input_len is not None:
-            max_input_len = [min(len_, max_len) for len_, max_len in zip(max_input_len, self.max_input_len)]
-
-        # maximum output length in this batch
+        return get_batch(data, decoding=decoding, **self.batch_params)
+
+
+def get_batch(data, binary, embedding_size, max_input_len=None, max_output_len=None, reverse_input=False,
+              decoding=False):
+    """
+    Pad a list of examples (token ids or feature vectors for each encoder and decoder) into numpy arrays.
+
+    This is a module-level function (rather than a method of `Seq2SeqModel`) so that it can be sent to the
+    worker processes of `utils.prefetch_iterator`. Use `Seq2SeqModel.batch_params` for the keyword arguments.
+
+    :param data: list of examples
+    :param binary: list of booleans, whether each encoder takes feature vectors instead of token ids
+    :param embedding_size: list of input dimensions of each encoder (only used by binary encoders)
+    :param max_input_len: list of maximum input lengths of each encoder (longer inputs are truncated)
+    :param max_output_len: list of maximum output lengths of each decoder
+    :param reverse_input: reverse the input sequences
+    :param decoding: set this parameter to True to output dummy
+      data for the decoder side (using the maximum output size)
+    :return: tuple (inputs, targets, input_length) of lists of numpy arrays
+    """
+    encoder_count = len(binary)
+    decoder_count = len(max_output_len)
+    batch_size = len(data)
+
+    max_output_len_ = max_output_len
+
+    # maximum input length of each encoder in this batch
+    batch_max_input_len = [max(len(data_[i]) for data_ in data) for i in range(encoder_count)]
+
+    if max_input_len is not None:
+        batch_max_input_len = [min(len_, max_len) for len_, max_len in zip(batch_max_input_len, max_input_len)]
+
+    # maximum output length in this batch
+    if not decoding:
+        max_output_len = [max(len(data_[i]) for data_ in data)
+                          for i in range(encoder_count, encoder_count + decoder_count)]
+        if max_output_len_ is not None:
+            max_output_len = [min(len_, max_len) for len_, max_len in zip(max_output_len, max_output_len_)]
+
+    # arrays are allocated with their padding value, and sequences are copied into them
+    inputs = []
+    input_length = []
+    for i, binary_ in enumerate(binary):
+        eos = 0 if binary_ else 1   # end of sentence marker for non-binary input
+        if binary_:
+            inputs_ = np.zeros((batch_size, batch_max_input_len[i], embedding_size[i]), dtype=np.float32)
+        else:
+            inputs_ = np.full((batch_size, batch_max_input_len[i] + eos), utils.EOS_ID, dtype=np.int32)
+        input_length_ = np.zeros(batch_size, dtype=np.int32)
+
+        for j, sentences in enumerate(data):
+            src_sentence = sentences[i][:batch_max_input_len[i]]
+            if reverse_input:
+                src_sentence = src_sentence[::-1]
+            if len(src_sentence) > 0:
+                inputs_[j, :len(src_sentence)] = src_sentence
+            input_length_[j] = len(src_sentence) + eos
+
+        inputs.append(inputs_)
+        input_length.append(input_length_)
+
+    # starts with BOS and ends with EOS
+    targets = []
+    for i in range(decoder_count):
         if decoding:
-            max_output_len = self.max_output_len
+            targets_ = np.full((batch_size, max_output_len_[i] + 1), utils.BOS_ID, dtype=np.int32)
+            targets_[:, -1] = utils.EOS_ID
         else:
-            max_output_len = [max(len(data_[i]) for data_ in data)
-                              for i in range(len(self.encoders), len(self.encoders) + len(self.decoders))]
-            if self.max_output_len is not None:
-                max_output_len = [min(len_, max_len) for len_, max_len in zip(max_output_len, self.max_output_len)]
-
-        for sentences in data:
-            src_sentences = sentences[:len(self.encoders)]
-            trg_sentences = sentences[len(self.encoders):]
-
-            for i, (encoder, src_sentence) in enumerate(zip(self.encoders, src_sentences)):
-                src_sentence = src_sentence[:max_input_len[i]]
-                pad_symbol = np.zeros(encoder.embedding_size, dtype=np.float32) if encoder.binary else utils.EOS_ID
-                # pad sequences so that all sequences in the same batch have the same length
-
-                eos = 0 if encoder.binary else 1   # end of sentence marker for non-binary input
-                encoder_pad = [pad_symbol] * (eos + max_input_len[i] - len(src_sentence))
-
-                if self.reverse_input:
-                    src_sentence = src_sentence[::-1]
-
-                inputs[i].append(src_sentence + encoder_pad)
-                input_length[i].append(len(src_sentence) + eos)
-
-            for i in range(len(self.decoders)):
-                if decoding:
-                    targets[i].append([utils.BOS_ID] * self.max_output_len[i] + [utils.EOS_ID])
-                else:
-                    trg_sentence = trg_sentences[i][:max_output_len[i]]
-                    decoder_pad_size = max_output_len[i] - len(trg_sentence) + 1
-                    trg_sentence = [utils.BOS_ID] + trg_sentence + [utils.EOS_ID] * decoder_pad_size
-                    targets[i].append(trg_sentence)
-
-        # convert lists to numpy arrays
-        inputs = [np.array(inputs_, dtype=np.float32 if encoder.binary else np.int32)
-                  for encoder, inputs_ in zip(self.encoders, inputs)]
-        # starts with BOS and ends with EOS
-        targets = [np.array(targets_, dtype=np.int32) for targets_ in targets]
-        input_length = [np.array(input_length_, dtype=np.int32) for input_length_ in input_length]
-
-        return inputs, targets, input_length
+            targets_ = np.full((batch_size, max_output_len[i] + 2), utils.EOS_ID, dtype=np.int32)
+            targets_[:, 0] = utils.BOS_ID
+            for j, sentences in enumerate(data):
+                trg_sentence = sentences[encoder_count + i][:max_output_len[i]]
+                targets_[j, 1:len(trg_sentence) + 1] = trg_sentence
+        targets.append(targets_)
+
+    return inputs, targets, input_length
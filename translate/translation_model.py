@@ -8,8 +8,14 @@ import sys
 import math
 import shutil
 import itertools
+import functools
+import operator
+import queue
+import json
+import concurrent.futures
 from collections import OrderedDict
 from translate import utils, evaluation
+from translate import seq2seq_model
 from translate.seq2seq_model import Seq2SeqModel
 from subprocess import Popen, PIPE
 
@@ -18,9 +24,18 @@ class TranslationModel:
     def __init__(self, encoders, decoders, checkpoint_dir, learning_rate, learning_rate_decay_factor,
                  batch_size, keep_best=1, dev_prefix=None, name=None, ref_ext=None,
                  pred_edits=False, dual_output=False, binary=None, truncate_lines=True, ensemble=False,
-                 checkpoints=None, beam_size=1, len_normalization=1, lexicon=None, debug=False, **kwargs):
+                 checkpoints=None, beam_size=1, len_normalization=1, lexicon=None, debug=False, replicas=1,
+                 task_index=0, accumulate_steps=1, background_eval=False, max_len_ratio=None, max_len_offset=0,
+                 shortlist=None, shortlist_size=10, shortlist_frequent=1000, **kwargs):
 
         self.batch_size = batch_size
+        # synchronous data-parallel training: each update averages `replicas` batches (one per worker)
+        self.replicas = replicas
+        self.task_index = task_index
+        # number of lines per update (used to count epochs), with data-parallel training and gradient accumulation
+        self.update_size = batch_size * replicas * (accumulate_steps or 1)
+        # dev set evaluation is done by a separate process (see `eval_worker`)
+        self.background_eval = background_eval
         self.character_level = {}
         self.binary = []
         self.debug = debug
@@ -82,6 +97,17 @@ class TranslationModel:
                 else:
                     encoder_or_decoder.vocab_size = len(vocab.reverse)
 
+        if max_len_ratio == 'auto':
+            character_level = [self.character_level.get(ext) for ext in self.extensions]
+            try:
+                max_len_ratio = utils.estimate_length_ratio(self.filenames.train, offset=max_len_offset,
+                                                            binary=self.binary[:len(self.extensions)],
+                                                            character_level=character_level)
+                utils.log('maximum output length: {:.3f} * input length + {}'.format(max_len_ratio, max_len_offset))
+            except (IOError, ValueError):
+                utils.warn('cannot estimate the maximum output length from the training data')
+                max_len_ratio = None
+
         utils.debug('creating model')
 
         self.models = []
@@ -90,52 +116,114 @@ class TranslationModel:
                 with tf.variable_scope('model_{}'.format(i)):
                     model = Seq2SeqModel(encoders, decoders, self.learning_rate, self.global_step, name=name,
                                          pred_edits=pred_edits, dual_output=dual_output,
-                                         baseline_step=self.baseline_step, **kwargs)
+                                         baseline_step=self.baseline_step, replicas=replicas,
+                                         task_index=task_index, accumulate_steps=accumulate_steps,
+                                         shortlist=shortlist, **kwargs)
                     self.models.append(model)
             self.seq2seq_model = self.models[0]
         else:
             self.seq2seq_model = Seq2SeqModel(encoders, decoders, self.learning_rate, self.global_step, name=name,
                                               pred_edits=pred_edits, dual_output=dual_output,
-                                              baseline_step=self.baseline_step, **kwargs)
+                                              baseline_step=self.baseline_step, replicas=replicas,
+                                              task_index=task_index, accumulate_steps=accumulate_steps,
+                                              shortlist=shortlist, **kwargs)
             self.models.append(self.seq2seq_model)
 
-        self.seq2seq_model.create_beam_op(self.models, len_normalization)
+        self.seq2seq_model.create_beam_op(self.models, len_normalization, max_len_ratio=max_len_ratio,
+                                          max_len_offset=max_len_offset)
 
         self.batch_iterator = None
+        self.batches = None
         self.dev_batches = None
+        self.eval_sets = {}
         self.train_size = None
         self.saver = None
+        self.shadow = None
+        self.save_executor = None
+        self.pending_saves = []
         self.keep_best = keep_best
         self.checkpoint_dir = checkpoint_dir
-        self.epoch = None
 
         self.training = utils.AttrDict()  # used to keep track of training
 
         if lexicon:
+            self.lexicon = {}
             with open(lexicon) as lexicon_file:
-                self.lexicon = dict(line.split() for line in lexicon_file)
+                for line in lexicon_file:   # a word can have several translations (the best one comes first)
+                    source, target = line.split()
+                    self.lexicon.setdefault(source, target)
         else:
             self.lexicon = None
 
+        self.shortlist = None
+        if shortlist:
+            self.read_shortlist(shortlist, shortlist_size, shortlist_frequent)
+
     def read_data(self, max_train_size, max_dev_size, read_ahead=10, batch_mode='standard', shuffle=True,
-                  crash_test=False, **kwargs):
+                  crash_test=False, cache_dir=None, max_tokens=None, padding_ratio=0.1, tokenization_workers=1,
+                  shard_mode='sequential', batch_state=None, **kwargs):
         utils.debug('reading training data')
         self.batch_iterator, self.train_size = utils.get_batch_iterator(
             self.filenames.train, self.extensions, self.vocabs, self.batch_size,
             max_size=max_train_size, character_level=self.character_level, max_seq_len=self.max_len,
-            read_ahead=read_ahead, mode=batch_mode, shuffle=shuffle, binary=self.binary, crash_test=crash_test
+            read_ahead=read_ahead, mode=batch_mode, shuffle=shuffle, binary=self.binary, crash_test=crash_test,
+            cache_dir=cache_dir, max_tokens=max_tokens, padding_ratio=padding_ratio,
+            tokenization_workers=tokenization_workers, shard_mode=shard_mode, state=batch_state
         )
 
+        self.read_dev_data(max_dev_size, tokenization_workers=tokenization_workers)
+
+    def read_dev_data(self, max_dev_size, tokenization_workers=1, **kwargs):
         utils.debug('reading development data')
 
         dev_sets = [
             utils.read_dataset(dev, self.extensions, self.vocabs, max_size=max_dev_size,
-                               character_level=self.character_level, binary=self.binary)[0]
+                               character_level=self.character_level, binary=self.binary,
+                               tokenization_workers=tokenization_workers)[0]
             for dev in self.filenames.dev
         ]
         # subset of the dev set whose loss is periodically evaluated
         self.dev_batches = [utils.get_batches(dev_set, batch_size=self.batch_size) for dev_set in dev_sets]
 
+    def read_shortlist(self, lexicon, size, frequent):
+        """
+        Read the lexicon used to restrict the output vocabulary of the beam-search decoder (see `get_shortlist`)
+
+        :param lexicon: path to the lexicon, with one translation per line (`source target`), from
+          the best translation to the worst (e.g., created by `scripts/extract-lexicon.py`)
+        :param size: number of translations of each source word that are kept
+        :param frequent: number of most frequent target words which are always in the shortlist
+        """
+        assert not self.binary[0], 'the shortlist needs a text input for the first encoder'
+        src_vocab, trg_vocab = self.src_vocab[0].vocab, self.trg_vocab[0].vocab
+        self.shortlist = {}
+
+        with open(lexicon) as lexicon_file:
+            for line in lexicon_file:
+                source, target = line.split()
+                if source in src_vocab and target in trg_vocab:
+                    translations = self.shortlist.setdefault(src_vocab[source], [])
+                    if len(translations) < size:
+                        translations.append(trg_vocab[target])
+
+        # the vocabulary is sorted by frequency (after the special symbols)
+        frequent = max(frequent, len(utils._START_VOCAB))
+        self.shortlist_frequent = list(range(min(frequent, self.decoders[0].vocab_size)))
+
+    def get_shortlist(self, token_ids):
+        """
+        Candidate output words for a batch: the translations of its source words (in the first encoder),
+        and the most frequent target words.
+
+        :param token_ids: list of examples (token ids for each encoder and decoder)
+        :return: sorted array of target vocabulary ids
+        """
+        ids = set(self.shortlist_frequent)
+        for token_ids_ in token_ids:
+            for src_id in token_ids_[0]:
+                ids.update(self.shortlist.get(src_id, []))
+        return np.array(sorted(ids), dtype=np.int32)
+
     def read_vocab(self):
         # don't try reading vocabulary for encoders that take pre-computed features
         self.vocabs = [
@@ -144,30 +232,38 @@ class TranslationModel:
         ]
         self.src_vocab, self.trg_vocab = self.vocabs[:len(self.src_ext)], self.vocabs[len(self.src_ext):]
 
+    def map_to_ids(self, sentence_tuple):
+        token_ids = [
+            sentence if vocab is None else
+            utils.sentence_to_token_ids(sentence, vocab.vocab, character_level=self.character_level.get(ext))
+            for ext, vocab, sentence in zip(self.extensions, self.vocabs, sentence_tuple)
+        ]
+        return token_ids
+
     def decode_sentence(self, sentence_tuple, remove_unk=False):
         return next(self.decode_batch([sentence_tuple], remove_unk))
 
     def decode_batch(self, sentence_tuples, batch_size, remove_unk=False, fix_edits=True, unk_replace=False,
-                     align=False, reverse=False, output=None):
+                     align=False, reverse=False, output=None, token_ids=None):
+        if token_ids is None:
+            token_ids = map(self.map_to_ids, sentence_tuples)   # lazy
+        examples = zip(sentence_tuples, token_ids)
+
         if batch_size == 1:
-            batches = ([sentence_tuple] for sentence_tuple in sentence_tuples)   # lazy
+            batches = ([example] for example in examples)   # lazy
         else:
-            batch_count = int(math.ceil(len(sentence_tuples) / batch_size))
-            batches = [sentence_tuples[i * batch_size:(i + 1) * batch_size] for i in range(batch_count)]
-
-        def map_to_ids(sentence_tuple):
-            token_ids = [
-                sentence if vocab is None else
-                utils.sentence_to_token_ids(sentence, vocab.vocab, character_level=self.character_level.get(ext))
-                for ext, vocab, sentence in zip(self.extensions, self.vocabs, sentence_tuple)
-            ]
-            return token_ids
+            examples = list(examples)
+            batch_count = int(math.ceil(len(examples) / batch_size))
+            batches = [examples[i * batch_size:(i + 1) * batch_size] for i in range(batch_count)]
 
         line_id = 0
         for batch_id, batch in enumerate(batches):
-            token_ids = list(map(map_to_ids, batch))
-            batch_token_ids, batch_weights = self.seq2seq_model.greedy_decoding(token_ids, beam_size=self.beam_size,
-                                                                                align=unk_replace or align or self.debug)
+            batch, token_ids = zip(*batch)
+            shortlist = None if self.shortlist is None else self.get_shortlist(token_ids)
+            batch_token_ids, batch_weights = self.seq2seq_model.greedy_decoding(list(token_ids),
+                                                                                beam_size=self.beam_size,
+                                                                                align=unk_replace or align or self.debug,
+                                                                                shortlist=shortlist)
             batch_token_ids = zip(*batch_token_ids)
 
             for sentence_id, (src_tokens, trg_token_ids) in enumerate(zip(batch, batch_token_ids)):
@@ -259,7 +355,7 @@ class TranslationModel:
                 for ext, vocab, sentence in zip(self.extensions, self.vocabs, lines)
             ]
 
-            _, weights = self.seq2seq_model.step(data=[token_ids], align=True, update_model=False)
+            weights = self.seq2seq_model.step(data=[token_ids], align=True, update_model=False).weights
 
             trg_vocab = self.trg_vocab[0]
             trg_token_ids = token_ids[len(self.src_ext)]
@@ -365,27 +461,15 @@ class TranslationModel:
             else:  # TODO
                 dev_loss = 0
 
-            src_lines = list(utils.read_lines(filenames_[:len(self.src_ext)], binary=self.binary[:len(self.src_ext)]))
-            trg_lines = list(utils.read_lines([filenames_[len(self.src_ext)]]))
-
-            assert len(trg_lines) % len(src_lines) == 0
-
-            references = []
-            ref_count = len(trg_lines) // len(src_lines)
-            for i in range(len(src_lines)):
-                ref = trg_lines[i * ref_count:(i + 1) * ref_count]
-                ref = [ref_[0].strip().replace('@@ ', '').replace('@@', '') for ref_ in ref]
-                references.append(ref)
-
             if on_dev and max_dev_size:
                 max_size = max_dev_size
             elif not on_dev and max_test_size:
                 max_size = max_test_size
             else:
-                max_size = len(src_lines)
+                max_size = None
 
-            src_lines = src_lines[:max_size]
-            references = references[:max_size]
+            eval_set = self.read_eval_set(filenames_, max_size)
+            src_lines, references = eval_set.src_lines, eval_set.references
 
             hypotheses = []
             output_file = None
@@ -393,8 +477,14 @@ class TranslationModel:
                 if output_ is not None:
                     output_file = open(output_, 'w')
 
-                hypothesis_iter = self.decode_batch(src_lines, self.batch_size, remove_unk=remove_unk,
-                                                    fix_edits=fix_edits, unk_replace=unk_replace)
+                # decode by order of length (less padding), then restore the original order
+                hypothesis_iter = self.decode_batch([src_lines[i] for i in eval_set.order], self.batch_size,
+                                                    remove_unk=remove_unk, fix_edits=fix_edits,
+                                                    unk_replace=unk_replace,
+                                                    token_ids=[eval_set.token_ids[i] for i in eval_set.order])
+                hypothesis_iter = [hypothesis for _, hypothesis in
+                                   sorted(zip(eval_set.order, hypothesis_iter), key=operator.itemgetter(0))]
+
                 if post_process_script is not None:
                     hypotheses, raw = zip(*hypothesis_iter)
                     data = '\n'.join(hypotheses).encode()
@@ -456,15 +546,54 @@ class TranslationModel:
 
         return scores
 
+    def read_eval_set(self, filenames, max_size=None):
+        """
+        Read an evaluation corpus, tokenize its source side and post-process its references.
+        This is only done once per corpus, as the same dev sets are evaluated periodically during training.
+
+        :param filenames: source files, followed by the reference file (which can contain several
+          consecutive references per source line)
+        :param max_size: maximum number of lines to read
+        :return: AttrDict containing the source lines, their token ids, the references, and the order
+          by length in which the lines should be decoded
+        """
+        key = (tuple(filenames), max_size)
+        if key in self.eval_sets:
+            return self.eval_sets[key]
+
+        src_lines = list(utils.read_lines(filenames[:len(self.src_ext)], binary=self.binary[:len(self.src_ext)]))
+        trg_lines = list(utils.read_lines([filenames[len(self.src_ext)]]))
+
+        assert len(trg_lines) % len(src_lines) == 0
+
+        references = []
+        ref_count = len(trg_lines) // len(src_lines)
+        for i in range(len(src_lines)):
+            ref = trg_lines[i * ref_count:(i + 1) * ref_count]
+            ref = [ref_[0].strip().replace('@@ ', '').replace('@@', '') for ref_ in ref]
+            references.append(ref)
+
+        max_size = max_size or len(src_lines)
+        src_lines = src_lines[:max_size]
+        references = references[:max_size]
+
+        token_ids = [self.map_to_ids(sentence_tuple) for sentence_tuple in src_lines]
+        order = sorted(range(len(token_ids)), key=lambda i: list(map(len, token_ids[i])))
+
+        eval_set = utils.AttrDict(src_lines=src_lines, references=references, token_ids=token_ids, order=order)
+        self.eval_sets[key] = eval_set
+        return eval_set
+
     def train(self, baseline_steps=0, loss_function='xent', use_baseline=True, **kwargs):
-        self.init_training(**kwargs)
+        self.init_training(loss_function=loss_function, **kwargs)
 
         if (loss_function == 'reinforce' and use_baseline and baseline_steps > 0 and
                     self.baseline_step.eval() < baseline_steps):
             utils.log('pre-training reinforce baseline')
             for i in range(baseline_steps - self.baseline_step.eval()):
-                self.seq2seq_model.reinforce_step(next(self.batch_iterator), update_model=False,
-                                                  use_sgd=False, update_baseline=True)
+                (data, self.training.batch_state), batch = next(self.batches)
+                self.seq2seq_model.reinforce_step(data, update_model=False, use_sgd=False, update_baseline=True,
+                                                  batch=batch)
 
         utils.log('starting training')
         while True:
@@ -473,32 +602,69 @@ class TranslationModel:
             except (utils.FinishedTrainingException, KeyboardInterrupt):
                 utils.log('exiting...')
                 self.save()
+                self.wait_for_save()
                 return
             except utils.EvalException:
                 self.save()
-                step, score = self.training.scores[-1]
-                self.manage_best_checkpoints(step, score)
+                self.run_after_save(self.manage_eval)   # once the checkpoint is written
             except utils.CheckpointException:
                 self.save()
 
-    def init_training(self, sgd_after_n_epoch=None, **kwargs):
-        self.read_data(**kwargs)
-        self.epoch = self.batch_size * self.global_step // self.train_size
-
+    def init_training(self, sgd_after_n_epoch=None, prefetch=0, prefetch_workers=1, prefetch_processes=False,
+                      loss_function='xent', **kwargs):
         global_step = self.global_step.eval()
-        epoch = self.epoch.eval()
+
+        # resume the batch iterator where it was when the checkpoint was saved, otherwise start a new one
+        self.batch_state = self.load_batch_state(global_step) or utils.AttrDict(seed=kwargs.get('seed'))
+        self.read_data(batch_state=self.batch_state, **kwargs)
+
+        epoch = self.update_size * global_step // self.train_size
         if sgd_after_n_epoch is not None and epoch >= sgd_after_n_epoch:  # already switched to SGD
             self.training.use_sgd = True
         else:
             self.training.use_sgd = False
 
-        if kwargs.get('batch_mode') != 'random' and not kwargs.get('shuffle'):
-            # read all the data up to this step (only if the batch iteration method is deterministic)
-            for _ in range(global_step):
-                next(self.batch_iterator)
+        # padding and conversion to numpy arrays is done by background workers, while the model is training.
+        # The iterator's state is copied after each batch, as the iterator runs ahead of training.
+        # In data-parallel training, all the workers read the same batches, and each worker takes one batch out
+        # of `replicas`.
+        batch_iterator = itertools.islice(self.batch_iterator, self.task_index, None, self.replicas)
+        batch_iterator = ((data, utils.AttrDict(self.batch_state)) for data in batch_iterator)
+        get_batch = functools.partial(seq2seq_model.get_batch, **self.seq2seq_model.batch_params)
+        self.batches = utils.prefetch_iterator(batch_iterator, get_batch, queue_size=prefetch,
+                                               workers=prefetch_workers, processes=prefetch_processes,
+                                               key=operator.itemgetter(0))
+
+        # REINFORCE steps need the batches on the Python side, and feed them
+        self.training.use_pipeline = self.seq2seq_model.pipeline is not None and loss_function != 'reinforce'
+
+        if self.training.use_pipeline:
+            # the batches are read by the tf.data pipeline (in a TensorFlow thread). The number of tokens,
+            # iterator state and time spent reading each batch are put in a queue, in the same order.
+            self.pipeline_info = queue.Queue()
+
+            def pipeline_generator():
+                while True:
+                    start_time = time.time()
+                    try:
+                        (data, batch_state), (encoder_inputs, targets, input_length) = next(self.batches)
+                    except StopIteration:
+                        return
+                    tokens = sum(len(line) for lines in data for line in lines)
+                    self.pipeline_info.put((tokens, batch_state, time.time() - start_time))
+                    yield tuple(encoder_inputs) + tuple(input_length) + tuple(targets)
+
+            self.seq2seq_model.pipeline_generator = pipeline_generator
+            tf.get_default_session().run(self.seq2seq_model.pipeline.initializer)
 
         # those parameters are used to track the progress of training
+        # (global step and learning rate are given by each training step, to avoid extra session calls)
+        self.training.global_step = global_step
+        self.training.epoch = epoch
+        self.training.learning_rate = self.learning_rate.eval()
         self.training.time = 0
+        self.training.wait_time = 0
+        self.training.tokens = 0
         self.training.steps = 0
         self.training.loss = 0
         self.training.baseline_loss = 0
@@ -510,10 +676,10 @@ class TranslationModel:
                    max_epochs=0, eval_burn_in=0, decay_if_no_progress=None, decay_after_n_epoch=None,
                    decay_every_n_epoch=None, sgd_after_n_epoch=None, sgd_learning_rate=None, min_learning_rate=None,
                    loss_function='xent', use_baseline=True, **kwargs):
-        if min_learning_rate is not None and self.learning_rate.eval() < min_learning_rate:
+        if min_learning_rate is not None and self.training.learning_rate < min_learning_rate:
             utils.debug('learning rate is too small: stopping')
             raise utils.FinishedTrainingException
-        if 0 < max_steps <= self.global_step.eval() or 0 < max_epochs <= self.epoch.eval():
+        if 0 < max_steps <= self.training.global_step or 0 < max_epochs <= self.training.epoch:
             raise utils.FinishedTrainingException
 
         start_time = time.time()
@@ -523,40 +689,66 @@ class TranslationModel:
         else:
             step_function = self.seq2seq_model.step
 
-        res = step_function(next(self.batch_iterator), update_model=True, use_sgd=self.training.use_sgd,
-                            update_baseline=True)
+        if self.training.use_pipeline:
+            # the batch is read from the input pipeline, by the same `session.run` call
+            res = step_function(update_model=True, use_sgd=self.training.use_sgd, update_baseline=True)
+            tokens, self.training.batch_state, wait_time = self.pipeline_info.get_nowait()
+            # time spent by the batch iterator (in Python), which can slow down training even when it runs
+            # in the background
+            self.training.wait_time += wait_time
+        else:
+            (data, self.training.batch_state), batch = next(self.batches)
+            self.training.wait_time += time.time() - start_time
+
+            res = step_function(data, update_model=True, use_sgd=self.training.use_sgd, update_baseline=True,
+                                batch=batch)
+            tokens = sum(len(line) for lines in data for line in lines)
 
         self.training.loss += res.loss
+        self.training.tokens += tokens
         self.training.baseline_loss += getattr(res, 'baseline_loss', 0)
 
         self.training.time += time.time() - start_time
         self.training.steps += 1
 
-        global_step = self.global_step.eval()
-        epoch = self.epoch.eval()
+        if int(res.global_step) == self.training.global_step:
+            return   # the gradients were only accumulated (see `accumulate_steps`)
+
+        global_step = self.training.global_step = int(res.global_step)
+        epoch = self.training.epoch = self.update_size * global_step // self.train_size
+        self.training.learning_rate = res.learning_rate
+
+        # in data-parallel training, the learning rate variable is shared: only the first worker updates it
+        chief = self.task_index == 0
 
-        if decay_after_n_epoch is not None and self.batch_size * global_step >= decay_after_n_epoch * self.train_size:
-            if decay_every_n_epoch is not None and (self.batch_size * (global_step - self.training.last_decay)
+        if (chief and decay_after_n_epoch is not None and
+                self.update_size * global_step >= decay_after_n_epoch * self.train_size):
+            if decay_every_n_epoch is not None and (self.update_size * (global_step - self.training.last_decay)
                                                     >= decay_every_n_epoch * self.train_size):
-                self.learning_rate_decay_op.eval()
-                utils.debug('  decaying learning rate to: {:.3g}'.format(self.learning_rate.eval()))
+                self.training.learning_rate = self.learning_rate_decay_op.eval()
+                utils.debug('  decaying learning rate to: {:.3g}'.format(self.training.learning_rate))
                 self.training.last_decay = global_step
 
         if sgd_after_n_epoch is not None and epoch >= sgd_after_n_epoch:
             if not self.training.use_sgd:
                 utils.debug('epoch {}, starting to use SGD'.format(epoch + 1))
                 self.training.use_sgd = True
-                if sgd_learning_rate is not None:
-                    self.learning_rate.assign(sgd_learning_rate).eval()
+                if chief and sgd_learning_rate is not None:
+                    self.training.learning_rate = self.learning_rate.assign(sgd_learning_rate).eval()
                 self.training.last_decay = global_step  # reset learning rate decay
 
         if steps_per_checkpoint and global_step % steps_per_checkpoint == 0:
             loss = self.training.loss / self.training.steps
             baseline_loss = self.training.baseline_loss / self.training.steps
             step_time = self.training.time / self.training.steps
+            wait_ratio = self.training.wait_time / self.training.time
+            batch_tokens = self.training.tokens / self.training.steps
+            tokens_per_sec = self.training.tokens / self.training.time
 
-            summary = 'step {} epoch {} learning rate {:.3g} step-time {:.3f} loss {:.3f}'.format(
-                global_step, epoch + 1, self.learning_rate.eval(), step_time, loss)
+            summary = ('step {} epoch {} learning rate {:.3g} step-time {:.3f} data-wait {:.1%} batch-tokens {:.0f} '
+                       'tokens/s {:.0f} loss {:.3f}').format(global_step, epoch + 1, self.training.learning_rate,
+                                                             step_time, wait_ratio, batch_tokens, tokens_per_sec,
+                                                             loss)
 
             if self.name is not None:
                 summary = '{} {}'.format(self.name, summary)
@@ -565,29 +757,22 @@ class TranslationModel:
 
             utils.log(summary)
 
-            if decay_if_no_progress and len(self.training.losses) >= decay_if_no_progress:
+            if chief and decay_if_no_progress and len(self.training.losses) >= decay_if_no_progress:
                 if loss >= max(self.training.losses[:decay_if_no_progress]):
-                    self.learning_rate_decay_op.eval()
+                    self.training.learning_rate = self.learning_rate_decay_op.eval()
 
             self.training.losses.append(loss)
             self.training.loss, self.training.time, self.training.steps, self.training.baseline_loss = 0, 0, 0, 0
+            self.training.wait_time, self.training.tokens = 0, 0
 
-        if steps_per_eval and global_step % steps_per_eval == 0 and 0 <= eval_burn_in <= global_step:
-
-            eval_dir = 'eval' if self.name is None else 'eval_{}'.format(self.name)
-            eval_output = os.path.join(model_dir, eval_dir)
+        if not chief:   # only the first worker evaluates and saves the model
+            return
 
-            os.makedirs(eval_output, exist_ok=True)
-
-            # if there are several dev files, we define several output files
-            output = [
-                os.path.join(eval_output, '{}.{}.out'.format(prefix, global_step))
-                for prefix in self.dev_prefix
-            ]
-
-            kwargs_ = dict(kwargs)
-            kwargs_['output'] = output
-            score, *_ = self.evaluate(on_dev=True, **kwargs_)
+        if steps_per_eval and global_step % steps_per_eval == 0 and 0 <= eval_burn_in <= global_step:
+            if self.background_eval:   # the checkpoint will be evaluated by the evaluation worker
+                score = None
+            else:
+                score = self.evaluate_checkpoint(global_step, model_dir, **kwargs)
             self.training.scores.append((global_step, score))
 
         if steps_per_eval and global_step % steps_per_eval == 0:
@@ -595,7 +780,81 @@ class TranslationModel:
         elif steps_per_checkpoint and global_step % steps_per_checkpoint == 0:
             raise utils.CheckpointException
 
-    def manage_best_checkpoints(self, step, score):
+    def evaluate_checkpoint(self, step, model_dir, **kwargs):
+        """ Evaluate the current parameters on the dev set, and save the outputs in the 'eval' directory """
+        eval_dir = 'eval' if self.name is None else 'eval_{}'.format(self.name)
+        eval_output = os.path.join(model_dir, eval_dir)
+
+        os.makedirs(eval_output, exist_ok=True)
+
+        # if there are several dev files, we define several output files
+        output = [
+            os.path.join(eval_output, '{}.{}.out'.format(prefix, step))
+            for prefix in self.dev_prefix
+        ]
+
+        kwargs_ = dict(kwargs)
+        kwargs_['output'] = output
+        score, *_ = self.evaluate(on_dev=True, **kwargs_)
+        return score
+
+    def manage_eval(self):
+        """
+        Called after the checkpoint of an evaluation step is saved: update the best checkpoints, or
+        have the evaluation worker do it (with `background_eval`).
+        """
+        step, score = self.training.scores[-1]
+        if score is None:
+            # copy the checkpoint before it is removed by newer checkpoints. The evaluation worker looks for
+            # the index file: it is renamed last, and each file is only renamed once it is fully written.
+            prefix = 'translate-{}.'.format(step)
+            filenames = sorted((filename for filename in os.listdir(self.checkpoint_dir)
+                                if filename.startswith(prefix)), key=lambda filename: filename.endswith('.index'))
+            for filename in filenames:
+                dest_path = os.path.join(self.checkpoint_dir, filename.replace(prefix, 'eval-{}.'.format(step)))
+                shutil.copy(os.path.join(self.checkpoint_dir, filename), dest_path + '.tmp')
+                os.replace(dest_path + '.tmp', dest_path)
+        else:
+            self.manage_best_checkpoints(step, score)
+
+    def eval_worker(self, model_dir, **kwargs):
+        """
+        Evaluate the checkpoints copied by a training process with `background_eval` (see `manage_eval`),
+        and keep track of the best checkpoints. Stops when the training process is done, and all its
+        checkpoints are evaluated.
+        """
+        training_process = os.getppid()
+        sess = tf.get_default_session()
+        self.read_dev_data(**kwargs)   # for the `loss` score function
+        utils.log('waiting for checkpoints in {}'.format(self.checkpoint_dir))
+
+        while True:
+            steps = []
+            if os.path.isdir(self.checkpoint_dir):
+                for filename in os.listdir(self.checkpoint_dir):
+                    m = re.match(r'eval-(\d+)\.index$', filename)
+                    if m:
+                        steps.append(int(m.group(1)))
+
+            if not steps:
+                if os.getppid() != training_process:   # the training process has exited
+                    return
+                time.sleep(10)
+                continue
+
+            step = min(steps)
+            prefix = 'eval-{}'.format(step)
+            load_checkpoint(sess, None, os.path.join(self.checkpoint_dir, prefix), blacklist=['dropout_keep_prob'],
+                            **{k: kwargs.get(k) for k in ('variable_mapping', 'reverse_mapping')})
+            utils.log('evaluating checkpoint of step {}'.format(step))
+            score = self.evaluate_checkpoint(step, model_dir, **kwargs)
+            self.manage_best_checkpoints(step, score, name='eval')
+
+            for filename in os.listdir(self.checkpoint_dir):
+                if filename.startswith(prefix + '.'):
+                    os.remove(os.path.join(self.checkpoint_dir, filename))
+
+    def manage_best_checkpoints(self, step, score, name='translate'):
         score_filename = os.path.join(self.checkpoint_dir, 'scores.txt')
         # try loading previous scores
         try:
@@ -616,7 +875,7 @@ class TranslationModel:
         if any(score_ < score for score_, _ in best_scores) or not best_scores:
             # if this checkpoint is in the top, save it under a special name
 
-            prefix = 'translate-{}.'.format(step)
+            prefix = '{}-{}.'.format(name, step)
             dest_prefix = 'best-{}.'.format(step)
 
             absolute_best = all(score_ < score for score_, _ in best_scores)
@@ -650,21 +909,44 @@ class TranslationModel:
                 f.write('{:.2f} {}\n'.format(score_, step_))
 
     def initialize(self, checkpoints=None, reset=False, reset_learning_rate=False, max_to_keep=1,
-                   keep_every_n_hours=0, sess=None, whitelist=None, blacklist=None, **kwargs):
+                   keep_every_n_hours=0, sess=None, whitelist=None, blacklist=None, background_save=False,
+                   **kwargs):
         """
         :param checkpoints: list of checkpoints to load (instead of latest checkpoint)
         :param reset: don't load latest checkpoint, reset learning rate and global step
         :param reset_learning_rate: reset the learning rate to its initial value
         :param max_to_keep: keep this many latest checkpoints at all times
         :param keep_every_n_hours: and keep checkpoints every n hours
+        :param background_save: copy the variables to host memory when saving, and write the checkpoint files
+          in a background thread
         """
         sess = sess or tf.get_default_session()
 
         if keep_every_n_hours <= 0 or keep_every_n_hours is None:
             keep_every_n_hours = float('inf')
 
-        self.saver = tf.train.Saver(max_to_keep=max_to_keep, keep_checkpoint_every_n_hours=keep_every_n_hours,
-                                    sharded=False)
+        if background_save:
+            # the snapshot is written by a saver in a separate graph (with a copy of the variables), so that
+            # it doesn't need the training session
+            self.shadow = create_shadow_saver(tf.global_variables(), max_to_keep=max_to_keep,
+                                              keep_checkpoint_every_n_hours=keep_every_n_hours, sharded=False)
+            self.saver = self.shadow.saver
+            # a single thread, so that the files are written (and rotated) in the same order as the snapshots
+            self.save_executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+        else:
+            self.saver = tf.train.Saver(max_to_keep=max_to_keep, keep_checkpoint_every_n_hours=keep_every_n_hours,
+                                        sharded=False)
+
+        sess.run(tf.local_variables_initializer())   # not saved in checkpoints (e.g., gradient accumulation)
+
+        if self.task_index != 0:
+            # in data-parallel training, the variables are initialized (or loaded) by the first worker
+            uninitialized_variables = tf.report_uninitialized_variables(tf.global_variables())
+            while len(sess.run(uninitialized_variables)) > 0:
+                time.sleep(1)
+            for hook in self.seq2seq_model.sync_hooks:
+                hook.after_create_session(sess, coord=None)
+            return
 
         sess.run(tf.global_variables_initializer())
 
@@ -725,8 +1007,92 @@ class TranslationModel:
         utils.debug('global step: {}'.format(self.global_step.eval()))
         utils.debug('baseline step: {}'.format(self.baseline_step.eval()))
 
+        # starts the queue runner which aggregates the gradients of all the workers
+        for hook in self.seq2seq_model.sync_hooks:
+            hook.after_create_session(sess, coord=None)
+
     def save(self):
-        save_checkpoint(tf.get_default_session(), self.saver, self.checkpoint_dir, self.global_step)
+        if self.task_index != 0:   # the checkpoints are written by the first worker
+            return
+
+        if self.shadow is None:
+            save_checkpoint(tf.get_default_session(), self.saver, self.checkpoint_dir, self.global_step)
+            self.save_batch_state()
+            return
+
+        # only the snapshot stalls training, the checkpoint and batch state are written in the background
+        utils.debug('copying model parameters')
+        values = tf.get_default_session().run(self.shadow.source_variables)
+        batch_state = self.get_batch_state()
+
+        def write_checkpoint():
+            with self.shadow.graph.as_default():
+                for var, value in zip(self.shadow.variables, values):
+                    var.load(value, self.shadow.session)
+                save_checkpoint(self.shadow.session, self.saver, self.checkpoint_dir, self.shadow.global_step)
+            self.write_batch_state(batch_state)
+
+        self.run_after_save(write_checkpoint)
+
+    def run_after_save(self, fun, *args):
+        """
+        Call `fun` once the checkpoints being saved are written: in the background thread with
+        `background_save`, immediately otherwise.
+        """
+        if self.save_executor is None:
+            fun(*args)
+            return
+
+        # raise the errors of the previous writes
+        for future in self.pending_saves:
+            if future.done():
+                future.result()
+        self.pending_saves = [future for future in self.pending_saves if not future.done()]
+        self.pending_saves.append(self.save_executor.submit(fun, *args))
+
+    def wait_for_save(self):
+        """ Wait until all the checkpoints are written (before exiting) """
+        for future in self.pending_saves:
+            future.result()
+        self.pending_saves = []
+
+    def get_batch_state_path(self):
+        name = 'batch_state.json' if self.name is None else 'batch_state_{}.json'.format(self.name)
+        return os.path.join(self.checkpoint_dir, name)
+
+    def get_batch_state(self):
+        if not self.training.batch_state:
+            return None
+        return dict(self.training.batch_state, global_step=int(self.global_step.eval()))
+
+    def save_batch_state(self):
+        """
+        Save the state of the training batch iterator (state after the last batch used for training),
+        so that training can resume at the next batch.
+        """
+        self.write_batch_state(self.get_batch_state())
+
+    def write_batch_state(self, state):
+        if state is None:
+            return
+        filename = self.get_batch_state_path()
+        os.makedirs(self.checkpoint_dir, exist_ok=True)
+        with open(filename + '.tmp', 'w') as f:
+            json.dump(state, f)
+        os.replace(filename + '.tmp', filename)
+
+    def load_batch_state(self, global_step):
+        filename = self.get_batch_state_path()
+        if not os.path.exists(filename):
+            return None
+        with open(filename) as f:
+            state = utils.AttrDict(json.load(f))
+        if state.pop('global_step') != global_step:   # state doesn't correspond to the loaded checkpoint
+            utils.warn('batch iterator state does not match the checkpoint, starting a new iterator')
+            return None
+        utils.debug('resuming batch iterator: epoch {}, shard {}, offset {}'.format(state.epoch, state.shard,
+                                                                                   state.offset))
+        return state
 
 
 # hard-coded variables which can also be defined in config file (variable_mapping and reverse_mapping)
@@ -801,6 +1167,28 @@ def load_checkpoint(sess, checkpoint_dir, filename=None, blacklist=(), prefix=No
             utils.debug('  {} {}'.format(var.name, var.get_shape()))
 
 
+def create_shadow_saver(variables, **kwargs):
+    """
+    Create a copy of these variables in a separate graph and session (on CPU), with a saver which writes
+    checkpoints that are identical to those of `tf.train.Saver(**kwargs)` in the main graph.
+
+    :param variables: list of variables to copy (including the global step)
+    :return: AttrDict with the new graph, session, variables and saver, and the source variables
+    """
+    graph = tf.Graph()
+    with graph.as_default():
+        shadow_variables = [tf.Variable(tf.zeros(var.get_shape(), dtype=var.dtype.base_dtype), trainable=False,
+                                        name=var.op.name) for var in variables]
+        saver = tf.train.Saver({var.op.name: shadow_var for var, shadow_var in zip(variables, shadow_variables)},
+                               **kwargs)
+        global_step = next((shadow_var for var, shadow_var in zip(variables, shadow_variables)
+                            if var.op.name == 'global_step'), None)
+        session = tf.Session(graph=graph, config=tf.ConfigProto(device_count={'GPU': 0}))
+
+    return utils.AttrDict(graph=graph, session=session, variables=shadow_variables, saver=saver,
+                          global_step=global_step, source_variables=list(variables))
+
+
 def save_checkpoint(sess, saver, checkpoint_dir, step=None, name=None):
     var_file = os.path.join(checkpoint_dir, 'vars.pkl')
     name = name or 'translate'
@@ -12,6 +12,17 @@ import collections
 import functools
 import operator
 import heapq
+import gzip
+import lzma
+import bz2
+import itertools
+import hashlib
+import array
+import threading
+import queue
+import multiprocessing
+
+from concurrent import futures
 
 from collections import namedtuple
 from contextlib import contextmanager
@@ -63,7 +74,7 @@ def open_files(names, mode='r'):
             if name_ is None:
                 file_ = sys.stdin if 'r' in mode else sys.stdout
             else:
-                file_ = open(name_, mode=mode)
+                file_ = open_file(name_, mode=mode)
             files.append(file_)
         yield files
     finally:
@@ -71,6 +82,40 @@ def open_files(names, mode='r'):
             file_.close()
 
 
+_COMPRESSORS = {'.gz': gzip, '.xz': lzma, '.bz2': bz2}
+
+
+def is_compressed(filename):
+    return filename is not None and os.path.splitext(filename)[1] in _COMPRESSORS
+
+
+def open_file(filename, mode='r'):
+    """
+    Open a file, which is decompressed on the fly if its extension is `.gz`, `.xz` or `.bz2`
+    (in text mode, compressed files are read as UTF-8).
+    """
+    if not is_compressed(filename):
+        return open(filename, mode)
+
+    module = _COMPRESSORS[os.path.splitext(filename)[1]]
+    if 'b' in mode:
+        return module.open(filename, mode)
+    else:
+        return module.open(filename, mode.replace('t', '') + 't', encoding='utf-8')
+
+
+def find_file(filename):
+    """
+    Return `filename` if it exists, otherwise a compressed version of this file (e.g., `filename.gz`)
+    if there is one.
+    """
+    if not os.path.exists(filename):
+        for ext in _COMPRESSORS:
+            if os.path.exists(filename + ext):
+                return filename + ext
+    return filename
+
+
 class AttrDict(dict):
     """
     Dictionary whose keys can be accessed as attributes.
@@ -177,6 +222,114 @@ def sentence_to_token_ids(sentence, vocabulary, character_level=False):
     return [vocabulary.get(w, UNK_ID) for w in sentence]
 
 
+_tokenizer = None
+
+
+def _init_tokenizer(vocabs, character_level):
+    global _tokenizer
+    _tokenizer = vocabs, character_level
+
+
+def _tokenize_chunk(chunk):
+    """
+    Tokenize a chunk of examples in a worker process (initialized with `_init_tokenizer`).
+
+    :param chunk: list of examples (tuples of sentences)
+    :return: for each sentence in the tuples, a pair of int32 buffers: the concatenated token ids
+      of all the examples, and their lengths
+    """
+    vocabs, character_level = _tokenizer
+    outputs = []
+    for sentences, vocab, character_level_ in zip(zip(*chunk), vocabs, character_level):
+        ids = array.array('i')
+        lengths = array.array('i')
+        for sentence in sentences:
+            ids_ = sentence_to_token_ids(sentence, vocab, character_level=character_level_)
+            ids.extend(ids_)
+            lengths.append(len(ids_))
+        outputs.append((ids.tobytes(), lengths.tobytes()))
+    return outputs
+
+
+_tokenizer_pools = {}
+
+
+def get_tokenizer_pool(vocabs, character_level, workers):
+    """
+    Pool of worker processes which tokenize with these vocabularies. Starting a pool (and sending it
+    the vocabularies) is slow, so the pool is created once, and reused by the next calls (e.g., for each shard
+    of the training corpus). The pools are terminated when the main process exits.
+    """
+    key = (workers, tuple(map(id, vocabs)), tuple(character_level))
+    if key not in _tokenizer_pools:
+        context = multiprocessing.get_context('spawn')
+        pool = context.Pool(workers, initializer=_init_tokenizer, initargs=(vocabs, character_level))
+        _tokenizer_pools[key] = pool, vocabs   # keep a reference to the vocabularies, whose ids are in the key
+    pool, _ = _tokenizer_pools[key]
+    return pool
+
+
+def tokenize_lines(line_reader, vocabs, character_level, workers=1, chunk_size=10000, max_lines=None):
+    """
+    Tokenize the output of a line reader with a pool of worker processes. The order of the lines is preserved.
+
+    The lines are read by the calling thread, and sent to the workers in chunks. The workers send back compact
+    int32 buffers, which are split into numpy arrays (views of one array per chunk), instead of pickled
+    Python lists. At most `2 * workers` chunks are waiting to be tokenized.
+
+    :param line_reader: iterator of pairs `(inputs, positions)`, see `read_lines_from_position`
+    :param vocabs: one vocabulary dictionary per input (None for binary inputs, which are left as is)
+    :param character_level: one boolean per input
+    :param workers: number of worker processes
+    :param chunk_size: number of lines per chunk
+    :param max_lines: function which returns the maximum number of lines that the caller may still consume.
+      The reader is never consumed further than this, so that its state (e.g., the position of a compressed
+      stream) matches the last line given to the caller.
+    :return: iterator of pairs `(lines, positions)`, where `lines` contains the token ids of each input
+    """
+    text_ids = [i for i, vocab in enumerate(vocabs) if vocab is not None]
+    vocabs_ = [vocabs[i] for i in text_ids]
+    character_level_ = [bool(character_level[i]) for i in text_ids]
+
+    pool = get_tokenizer_pool(vocabs_, character_level_, workers)
+    pending = collections.deque()   # chunks being tokenized, with their results
+    pending_lines = 0
+    finished = False
+
+    while True:
+        while not finished and len(pending) < 2 * workers:
+            size = chunk_size
+            if max_lines is not None:
+                size = min(size, max_lines() - pending_lines)
+                if size <= 0:
+                    break
+            chunk = list(itertools.islice(line_reader, size))
+            if len(chunk) < size:
+                finished = True
+            if chunk:
+                sentences = [[inputs[i] for i in text_ids] for inputs, _ in chunk]
+                pending.append((chunk, pool.apply_async(_tokenize_chunk, (sentences,))))
+                pending_lines += len(chunk)
+
+        if not pending:
+            break
+
+        chunk, outputs = pending.popleft()
+        pending_lines -= len(chunk)
+
+        columns = []
+        for ids, lengths in outputs.get():
+            ids = np.frombuffer(ids, dtype=np.int32)
+            lengths = np.frombuffer(lengths, dtype=np.int32)
+            columns.append(np.split(ids, np.cumsum(lengths)[:-1]))
+
+        for j, (inputs, positions) in enumerate(chunk):
+            lines = list(inputs)
+            for i, column in zip(text_ids, columns):
+                lines[i] = column[j]
+            yield lines, positions
+
+
 def get_filenames(data_dir, model_dir, extensions, train_prefix, dev_prefix, vocab_prefix, name=None,
                   ref_ext=None, binary=None, decode=None, eval=None, align=None, **kwargs):
     """
@@ -194,13 +347,13 @@ def get_filenames(data_dir, model_dir, extensions, train_prefix, dev_prefix, voc
     train_path = os.path.join(data_dir, train_prefix)
     dev_path = [os.path.join(data_dir, prefix) for prefix in dev_prefix]
 
-    train = ['{}.{}'.format(train_path, ext) for ext in extensions]
+    train = [find_file('{}.{}'.format(train_path, ext)) for ext in extensions]
 
     dev_extensions = list(extensions)
     if ref_ext is not None and ref_ext != extensions[-1]:
         dev_extensions.append(ref_ext)
 
-    dev = [['{}.{}'.format(path, ext) for ext in dev_extensions] for path in dev_path]
+    dev = [[find_file('{}.{}'.format(path, ext)) for ext in dev_extensions] for path in dev_path]
 
     vocab_path = os.path.join(data_dir, vocab_prefix)
     vocab_src = ['{}.{}'.format(vocab_path, ext) for ext in extensions]
@@ -236,28 +389,45 @@ def get_filenames(data_dir, model_dir, extensions, train_prefix, dev_prefix, voc
 
 
 def read_dataset(paths, extensions, vocabs, max_size=None, character_level=None, sort_by_length=False,
-                 max_seq_len=None, from_position=None, binary=None):
+                 max_seq_len=None, from_position=None, binary=None, cache_dir=None, tokenization_workers=1,
+                 line_ids=None):
+    if cache_dir is not None and not any(binary or []):
+        return read_cached_dataset(paths, extensions, vocabs, cache_dir, max_size=max_size,
+                                   character_level=character_level, sort_by_length=sort_by_length,
+                                   max_seq_len=max_seq_len, from_position=from_position,
+                                   tokenization_workers=tokenization_workers, line_ids=line_ids)
+
     data_set = []
 
     if from_position is not None:
         debug('reading from position: {}'.format(from_position))
 
-    line_reader = read_lines_from_position(paths, from_position=from_position, binary=binary)
+    if line_ids is not None:
+        line_reader = read_lines_at(paths, line_ids, binary=binary)
+    else:
+        line_reader = read_lines_from_position(paths, from_position=from_position, binary=binary)
     character_level = character_level or {}
 
     positions = None
 
-    for inputs, positions in line_reader:
-        if len(data_set) > 0 and len(data_set) % 100000 == 0:
-            debug("  lines read: {}".format(len(data_set)))
-
-        lines = [
+    if tokenization_workers and tokenization_workers > 1:
+        # with `max_size`, lines are read ahead of the loop below, but no further than the lines it could need
+        max_lines = None if not max_size else lambda: max_size - len(data_set)
+        line_reader = tokenize_lines(
+            line_reader, [None if binary_ else vocab.vocab for vocab, binary_ in zip(vocabs, binary)],
+            [character_level.get(ext) for ext in extensions], workers=tokenization_workers, max_lines=max_lines)
+    else:
+        line_reader = (([
             input_ if binary_ else
             sentence_to_token_ids(input_, vocab.vocab, character_level=character_level.get(ext))
             for input_, vocab, binary_, ext in zip(inputs, vocabs, binary, extensions)
-        ]
+        ], positions) for inputs, positions in line_reader)
+
+    for lines, positions in line_reader:
+        if len(data_set) > 0 and len(data_set) % 100000 == 0:
+            debug("  lines read: {}".format(len(data_set)))
 
-        if not all(lines):  # skip empty inputs
+        if not all(map(len, lines)):  # skip empty inputs
             continue
         # skip lines that are too long
         if max_seq_len and any(len(line) > max_seq_len[ext] for line, ext in zip(lines, extensions)):
@@ -277,21 +447,210 @@ def read_dataset(paths, extensions, vocabs, max_size=None, character_level=None,
     return data_set, positions
 
 
-def random_batch_iterator(data, batch_size):
+def get_cache_key(path, vocab, character_level=False):
+    """
+    Compute the key of the token cache of a corpus file. This key changes when the corpus
+    is modified (size or modification time), or when its vocabulary or tokenization mode change.
+
+    :param path: path to the text corpus
+    :param vocab: vocabulary used to map the corpus to token ids (after truncation to `vocab_size`)
+    :param character_level: character-level or word-level tokenization
+    :return: hexadecimal string
+    """
+    stat = os.stat(path)
+    checksum = hashlib.md5()
+    checksum.update('{} {} {}\n'.format(os.path.abspath(path), stat.st_size, stat.st_mtime_ns).encode())
+    checksum.update('\n'.join(vocab.reverse).encode())
+    checksum.update(b'char' if character_level else b'word')
+    return checksum.hexdigest()
+
+
+def build_token_cache(path, vocab, ids_path, offsets_path, character_level=False, tokenization_workers=1):
+    """
+    Tokenize a corpus once and for all, and write the result to two files: a flat int32 file
+    containing the token ids of all the lines, and an int64 numpy array of size `lines + 1`,
+    such that the ids of line `i` are `ids[offsets[i]:offsets[i + 1]]`.
+
+    Files are written under temporary names and then renamed, so that several processes
+    building the same cache at the same time don't corrupt it.
+    """
+    debug('building token cache for {}'.format(path))
+    suffix = '.{}.tmp'.format(os.getpid())
+    offsets = array.array('q', [0])
+    buffer = array.array('i')
+
+    with open_file(path) as input_file, open(ids_path + suffix, 'wb') as ids_file:
+        if tokenization_workers and tokenization_workers > 1:
+            lines = (((line,), None) for line in input_file)
+            lines = (ids for (ids,), _ in tokenize_lines(lines, [vocab.vocab], [character_level],
+                                                         workers=tokenization_workers))
+        else:
+            lines = (sentence_to_token_ids(line, vocab.vocab, character_level=character_level)
+                     for line in input_file)
+
+        for ids in lines:
+            buffer.extend(ids)
+            offsets.append(offsets[-1] + len(ids))
+            if len(buffer) >= 1 << 20:
+                buffer.tofile(ids_file)
+                del buffer[:]
+        buffer.tofile(ids_file)
+
+    with open(offsets_path + suffix, 'wb') as offsets_file:
+        np.save(offsets_file, np.frombuffer(offsets, dtype=np.int64))
+
+    # the offsets file is renamed last: its presence means that the cache is complete
+    os.replace(ids_path + suffix, ids_path)
+    os.replace(offsets_path + suffix, offsets_path)
+    debug('  lines: {}, tokens: {}'.format(len(offsets) - 1, offsets[-1]))
+
+
+_token_caches = {}
+
+
+def load_token_cache(path, vocab, cache_dir, character_level=False, tokenization_workers=1):
+    """
+    Memory-map the token cache of a corpus file (and build it if it doesn't exist yet).
+    Because the files are memory-mapped read-only, training processes which use the same corpus
+    and vocabulary on the same machine share their page cache.
+
+    :return: pair of arrays (ids, offsets), see `build_token_cache`
+    """
+    key = get_cache_key(path, vocab, character_level=character_level)
+    prefix = os.path.join(cache_dir, '{}.{}'.format(os.path.basename(path), key[:16]))
+
+    if prefix not in _token_caches:
+        ids_path = prefix + '.ids'
+        offsets_path = prefix + '.offsets.npy'
+
+        if not os.path.exists(offsets_path):
+            os.makedirs(cache_dir, exist_ok=True)
+            build_token_cache(path, vocab, ids_path, offsets_path, character_level=character_level,
+                              tokenization_workers=tokenization_workers)
+
+        offsets = np.load(offsets_path, mmap_mode='r')
+        if offsets[-1] > 0:
+            ids = np.memmap(ids_path, dtype=np.int32, mode='r')
+        else:  # numpy can't map empty files
+            ids = np.zeros(0, dtype=np.int32)
+        _token_caches[prefix] = ids, offsets
+
+    return _token_caches[prefix]
+
+
+def read_cached_dataset(paths, extensions, vocabs, cache_dir, max_size=None, character_level=None,
+                        sort_by_length=False, max_seq_len=None, from_position=None, tokenization_workers=1,
+                        line_ids=None):
+    """
+    Same as `read_dataset`, but reads the token ids from a memory-mapped token cache (see `load_token_cache`)
+    instead of tokenizing the corpus. Lines are numpy views of the cache, and positions are line numbers.
+    """
+    character_level = character_level or {}
+    caches = [load_token_cache(path, vocab, cache_dir, character_level=character_level.get(ext),
+                               tokenization_workers=tokenization_workers)
+              for path, vocab, ext in zip(paths, vocabs, extensions)]
+
+    line_count = min(len(offsets) - 1 for _, offsets in caches)
+    start = from_position[0] if from_position is not None else 0
+
+    if from_position is not None:
+        debug('reading from position: {}'.format(start))
+
+    if line_ids is not None:
+        indices = np.asarray(line_ids, dtype=np.int64)
+        indices = indices[indices < line_count]
+    else:
+        indices = np.arange(start, max(line_count, start), dtype=np.int64)
+
+    # skip empty lines, and lines that are too long
+    keep = np.ones(len(indices), dtype=np.bool_)
+    for (_, offsets), ext in zip(caches, extensions):
+        lengths = offsets[indices + 1] - offsets[indices]
+        keep &= lengths > 0
+        if max_seq_len:
+            keep &= lengths <= max_seq_len[ext]
+
+    indices = indices[keep]
+    if max_size:
+        indices = indices[:max_size]
+
+    lines = []
+    for ids, offsets in caches:
+        starts = offsets[indices].tolist()
+        ends = offsets[indices + 1].tolist()
+        lines.append([ids[i:j] for i, j in zip(starts, ends)])
+
+    data_set = [list(lines_) for lines_ in zip(*lines)]
+
+    if max_size and len(indices) == max_size:
+        position = int(indices[-1]) + 1
+    else:
+        position = line_count
+
+    debug('files: {}'.format(' '.join(paths)))
+    debug('lines reads: {}'.format(len(data_set)))
+
+    if sort_by_length:
+        data_set.sort(key=lambda lines: list(map(len, lines)))
+
+    return data_set, (position,) * len(paths)
+
+
+def estimate_length_ratio(paths, offset=0, binary=None, character_level=None, max_size=100000, coverage=0.999):
+    """
+    Estimate from a parallel corpus the maximum output length of the decoder, as a linear function
+    of the input length: `ratio * input_length + offset`.
+
+    :param paths: source and target files (the first one is read by the encoder, the last one by the decoder)
+    :param offset: constant term of this function
+    :param binary: which files contain binary features
+    :param character_level: which files are read at the character level
+    :param max_size: number of lines to read
+    :param coverage: proportion of the sentence pairs whose target length should be within this limit
+    :return: the ratio (float)
+    """
+    binary = binary or [False] * len(paths)
+    character_level = character_level or [False] * len(paths)
+    paths = [paths[0], paths[-1]]
+    binary = [binary[0], binary[-1]]
+    character_level = [character_level[0], character_level[-1]]
+
+    def length(line, binary_, character_level_):
+        if binary_:
+            return len(line)
+        else:
+            return len(line.rstrip('\n') if character_level_ else line.split())
+
+    ratios = []
+    for lines in itertools.islice(read_lines(paths, binary=binary), max_size):
+        src_len, trg_len = [length(*args) for args in zip(lines, binary, character_level)]
+        if not binary[0]:
+            src_len += 1   # the input length includes EOS
+        ratios.append((trg_len - offset) / src_len)
+
+    if not ratios:
+        raise ValueError('no sentence pair in {}'.format(' '.join(paths)))
+
+    return max(0.0, float(np.percentile(ratios, 100 * coverage)))
+
+
+def random_batch_iterator(data, batch_size, rng=None):
     """
     The most basic form of batch iterator.
 
     :param data: the dataset to segment into batches
     :param batch_size: the size of a batch
+    :param rng: random number generator (instance of `random.Random`, defaults to the `random` module)
     :return: an iterator which yields random batches (indefinitely)
     """
+    rng = rng or random
     while True:
-        yield random.sample(data, batch_size)
+        yield rng.sample(data, batch_size)
 
 
-def basic_batch_iterator(data, batch_size, shuffle=False, allow_smaller=True):
+def basic_batch_iterator(data, batch_size, shuffle=False, allow_smaller=True, rng=None):
     if shuffle:
-        random.shuffle(data)
+        (rng or random).shuffle(data)
 
     batch_count = len(data) // batch_size
 
@@ -302,7 +661,7 @@ def basic_batch_iterator(data, batch_size, shuffle=False, allow_smaller=True):
         yield data[i * batch_size:(i + 1) * batch_size]
 
 
-def cycling_batch_iterator(data, batch_size, shuffle=True, allow_smaller=True):
+def cycling_batch_iterator(data, batch_size, shuffle=True, allow_smaller=True, rng=None):
     """
     Indefinitely cycle through a dataset and yield batches (the dataset is shuffled
     at each new epoch)
@@ -312,13 +671,160 @@ def cycling_batch_iterator(data, batch_size, shuffle=True, allow_smaller=True):
     :return: an iterator which yields batches (indefinitely)
     """
     while True:
-        iterator = basic_batch_iterator(data, batch_size, shuffle=shuffle, allow_smaller=allow_smaller)
+        iterator = basic_batch_iterator(data, batch_size, shuffle=shuffle, allow_smaller=allow_smaller, rng=rng)
         for batch in iterator:
             yield batch
 
 
+def token_batches(data, max_tokens):
+    """
+    Segment a list of examples (preferably sorted by length) into consecutive batches, whose padded size
+    (number of examples times the sum of the maximum source and target lengths) is at most `max_tokens`.
+    Examples which are too long on their own are put into single-example batches.
+
+    :param data: list of examples (one sequence for each encoder and decoder)
+    :param max_tokens: maximum number of padded tokens in a batch
+    :return: list of batches
+    """
+    batches = []
+    batch = []
+    max_len = None
+
+    for lines in data:
+        lengths = list(map(len, lines))
+        if batch:
+            new_max_len = [max(len_, max_len_) for len_, max_len_ in zip(lengths, max_len)]
+            if sum(new_max_len) * (len(batch) + 1) > max_tokens:
+                batches.append(batch)
+                batch = []
+                new_max_len = lengths
+        else:
+            new_max_len = lengths
+
+        batch.append(lines)
+        max_len = new_max_len
+
+    if batch:
+        batches.append(batch)
+    return batches
+
+
+def get_padding_ratio(batches):
+    """
+    Compute the proportion of padding tokens in a list of batches (each sequence being padded to the
+    length of the longest sequence at the same position in the batch)
+    """
+    total = 0
+    padded = 0
+    for batch in batches:
+        lengths = [list(map(len, lines)) for lines in batch]
+        total += sum(map(sum, lengths))
+        padded += len(batch) * sum(map(max, zip(*lengths)))
+    return 1 - total / padded if padded else 0.0
+
+
+def merge_buckets(buckets, min_size):
+    """
+    Merge the buckets which contain less than `min_size` examples with their nearest bucket in length
+    (the smallest ones first), until all the buckets contain at least `min_size` examples (or until there
+    is a single bucket).
+
+    :param buckets: dictionary whose keys are tuples of bucket indices (one per sequence), and values
+      are lists of examples
+    :param min_size: minimum size of a bucket
+    :return: list of buckets (lists of examples)
+    """
+    keys = sorted(buckets)
+    buckets = [buckets[key] for key in keys]
+    centers = np.array(keys, dtype=np.float64)   # average key of the examples in each bucket
+    sizes = np.array([len(bucket) for bucket in buckets], dtype=np.float64)
+    active = np.ones(len(buckets), dtype=bool)
+
+    while active.sum() > 1:
+        small = np.where(active & (sizes < min_size))[0]
+        if len(small) == 0:
+            break
+        i = small[np.argmin(sizes[small])]
+        distances = np.abs(centers - centers[i]).sum(axis=1)
+        distances[~active] = np.inf
+        distances[i] = np.inf
+        j = int(np.argmin(distances))
+
+        centers[j] = (centers[i] * sizes[i] + centers[j] * sizes[j]) / (sizes[i] + sizes[j])
+        sizes[j] += sizes[i]
+        buckets[j] += buckets[i]
+        active[i] = False
+
+    return [bucket for bucket, active_ in zip(buckets, active) if active_]
+
+
+def bucket_batch_iterator(data, batch_size, shuffle=True, allow_smaller=True, cycle=True, padding_ratio=0.1,
+                          rng=None):
+    """
+    Segment the entire dataset into batches of sequences of similar lengths.
+
+    The examples are grouped into buckets according to the lengths of all their sequences (sources and target).
+    Bucket boundaries grow geometrically, so that inside a bucket the proportion of padding tokens
+    is at most `padding_ratio`. Buckets with less than `batch_size` examples are merged with their nearest
+    buckets in length, which adds some padding (more so with small datasets and small values of `padding_ratio`).
+    At each new epoch, the examples are shuffled inside each bucket, each bucket is segmented into batches
+    (of at most `batch_size` examples), then the batches of all the buckets are shuffled.
+
+    :param data: the dataset to segment into batches
+    :param batch_size: the size of a batch
+    :param allow_smaller: allow batches smaller than `batch_size`: each bucket is then split into batches of
+      similar sizes, otherwise the examples beyond the last full batch of each bucket are skipped at this epoch
+    :param cycle: if True, cycle through the dataset indefinitely, otherwise stop after one epoch
+    :param padding_ratio: target proportion of padding tokens (smaller values mean more and smaller buckets,
+      and thus less randomness in the batches)
+    :param rng: random number generator (defaults to the `random` module)
+    :return: an iterator which yields batches
+    """
+    rng = rng or random
+    base = math.log(1 / (1 - padding_ratio)) if 0 < padding_ratio < 1 else None
+
+    def bucket_key(lines):
+        lengths = [max(len(line), 1) for line in lines]
+        lengths = lengths[-1:] + lengths[:-1]  # target first
+        if base is None:
+            return tuple(lengths)
+        return tuple(int(math.log(length) / base) for length in lengths)
+
+    buckets = collections.defaultdict(list)
+    for lines in data:
+        buckets[bucket_key(lines)].append(lines)
+    bucket_count = len(buckets)
+    buckets = merge_buckets(buckets, batch_size)
+    debug('bucket sampler: {} buckets ({} before merging)'.format(len(buckets), bucket_count))
+
+    while True:
+        if shuffle:
+            for bucket in buckets:
+                rng.shuffle(bucket)
+
+        batches = []
+        for bucket in buckets:
+            if allow_smaller:
+                count = int(math.ceil(len(bucket) / batch_size))
+                batches += [bucket[i * len(bucket) // count:(i + 1) * len(bucket) // count] for i in range(count)]
+            else:
+                count = len(bucket) // batch_size
+                batches += [bucket[i * batch_size:(i + 1) * batch_size] for i in range(count)]
+
+        log('bucket sampler: {} batches, padding ratio {:.1%} (target {:.1%})'.format(
+            len(batches), get_padding_ratio(batches), padding_ratio))
+
+        if shuffle:
+            rng.shuffle(batches)
+        yield from batches
+
+        if not cycle or not batches:
+            break
+
+
 def read_ahead_batch_iterator(data, batch_size, read_ahead=10, shuffle=True, allow_smaller=True,
-                              mode='standard', cycle=True, crash_test=False, **kwargs):
+                              mode='standard', cycle=True, crash_test=False, max_tokens=None, padding_ratio=0.1,
+                              rng=None, **kwargs):
     """
     Same iterator as `cycling_batch_iterator`, except that it reads a number of batches
     at once, and sorts their content according to their size.
@@ -330,14 +836,32 @@ def read_ahead_batch_iterator(data, batch_size, read_ahead=10, shuffle=True, all
     :param batch_size: the size of a batch
     :param read_ahead: number of batches to read ahead of time and sort (larger numbers
       mean faster training, but less random behavior)
+    :param mode: 'standard' (cycle through the dataset), 'random' (sample batches from the dataset),
+      'tokens' (like 'standard', but the sorted examples are packed into batches of at most `max_tokens`
+      padded tokens, instead of batches of `batch_size` examples), or 'bucket' (see `bucket_batch_iterator`,
+      `read_ahead` is then ignored)
+    :param max_tokens: maximum number of padded tokens (source + target) in a batch, in 'tokens' mode
+    :param padding_ratio: target proportion of padding tokens, in 'bucket' mode
+    :param cycle: if False, stop after one pass through the dataset (in 'random' mode, after
+      `len(data) // batch_size` batches)
+    :param rng: random number generator (defaults to the `random` module)
     :return: an iterator which yields batches (indefinitely)
     """
-    if not cycle:
-        iterator = basic_batch_iterator(data, batch_size, shuffle=shuffle, allow_smaller=allow_smaller)
-    elif mode == 'random':
-        iterator = random_batch_iterator(data, batch_size)
+    rng = rng or random
+
+    if mode == 'bucket' and not crash_test:
+        yield from bucket_batch_iterator(data, batch_size, shuffle=shuffle, allow_smaller=allow_smaller,
+                                         cycle=cycle, padding_ratio=padding_ratio, rng=rng)
+        return
+
+    if mode == 'random':
+        iterator = random_batch_iterator(data, batch_size, rng=rng)
+        if not cycle:
+            iterator = itertools.islice(iterator, max(len(data) // batch_size, 1))
+    elif not cycle:
+        iterator = basic_batch_iterator(data, batch_size, shuffle=shuffle, allow_smaller=allow_smaller, rng=rng)
     else:
-        iterator = cycling_batch_iterator(data, batch_size, shuffle=shuffle, allow_smaller=allow_smaller)
+        iterator = cycling_batch_iterator(data, batch_size, shuffle=shuffle, allow_smaller=allow_smaller, rng=rng)
 
     if crash_test:
         n = batch_size // 2
@@ -347,7 +871,9 @@ def read_ahead_batch_iterator(data, batch_size, read_ahead=10, shuffle=True, all
         while True:
             yield dummy_batch
 
-    if read_ahead is None or read_ahead <= 1:
+    if mode == 'tokens':
+        read_ahead = max(read_ahead or 1, 1)
+    elif read_ahead is None or read_ahead <= 1:
         yield from iterator
 
     while True:
@@ -358,55 +884,199 @@ def read_ahead_batch_iterator(data, batch_size, read_ahead=10, shuffle=True, all
                 break
 
         data_ = sorted(sum(batches, []), key=lambda lines: len(lines[-1]))
-        batches = [data_[i * batch_size:(i + 1) * batch_size] for i in range(read_ahead)]
+        if mode == 'tokens':
+            batches = token_batches(data_, max_tokens)
+        else:
+            batches = [data_[i * batch_size:(i + 1) * batch_size] for i in range(read_ahead)]
         batches = [batch for batch in batches if batch]  # filter empty batches
 
         if not any(batches):
             break
 
         if shuffle:  # TODO: enable shuffling here without epoch shuffling
-            random.shuffle(batches)
+            rng.shuffle(batches)
         for batch in batches:
             yield batch
 
 
 def get_batch_iterator(paths, extensions, vocabs, batch_size, max_size=None, character_level=None,
                        sort_by_length=False, max_seq_len=None, read_ahead=10, shuffle=True,
-                       binary=None, mode='standard', crash_test=False):
+                       binary=None, mode='standard', crash_test=False, cache_dir=None, max_tokens=None,
+                       padding_ratio=0.1, tokenization_workers=1, shard_mode='sequential', block_size=1000,
+                       state=None):
+    """
+    :param max_size: maximum number of lines in memory, if the corpus is larger it is read in shards
+      of `max_size` lines
+    :param shard_mode: 'sequential' (shards are consecutive slices of the corpus), or 'random' (at each epoch,
+      the corpus is split into blocks of `block_size` lines, which are shuffled and grouped into shards)
+    :param block_size: number of consecutive lines in a block, in 'random' shard mode (at most `max_size`).
+      This mode needs random access to the lines, so it isn't available for compressed text files
+      (unless they are read through the token cache).
+    :param state: state of the iterator (AttrDict), which is updated in place each time a batch is produced.
+      It contains a random seed, the current epoch, the current shard and the number of batches already
+      produced from this shard. All the randomness of the iterator is derived from the seed, the epoch and
+      the shard, so that an iterator created from a copy of `state` resumes exactly at the same batch,
+      without reading the previous shards.
+    :return: tuple (batch iterator, number of lines in the corpus)
+    """
+    if state is None:
+        state = AttrDict()
+    if state.seed is None:
+        state.seed = random.randrange(sys.maxsize)
+    state.epoch = state.epoch or 0
+    state.offset = state.offset or 0
+
     read_shard = functools.partial(read_dataset,
         paths=paths, extensions=extensions, vocabs=vocabs, max_size=max_size, max_seq_len=max_seq_len,
-        character_level=character_level, sort_by_length=sort_by_length, binary=binary)
+        character_level=character_level, sort_by_length=sort_by_length, binary=binary, cache_dir=cache_dir,
+        tokenization_workers=tokenization_workers)
     batch_iterator = functools.partial(read_ahead_batch_iterator, batch_size=batch_size, read_ahead=read_ahead,
-                                       shuffle=shuffle, mode=mode, crash_test=crash_test)
+                                       shuffle=shuffle, mode=mode, crash_test=crash_test, max_tokens=max_tokens,
+                                       padding_ratio=padding_ratio)
 
     # FIXME: crash test only for first shard
-    with open(paths[-1]) as f:   # count lines
-        line_count = sum(1 for _ in f)
-        debug('total line count: {}'.format(line_count))
+    if cache_dir is not None and not any(binary or []):
+        character_level = character_level or {}
+        _, offsets = load_token_cache(paths[-1], vocabs[-1], cache_dir,
+                                      character_level=character_level.get(extensions[-1]),
+                                      tokenization_workers=tokenization_workers)
+        line_count = len(offsets) - 1
+    else:
+        # build line indexes (only scans the files the first time), which give the line count and
+        # avoid calling `tell` for each line when reading shards
+        binary = binary or [False] * len(paths)
+        indexes = [None if binary_ else get_line_index(path) for path, binary_ in zip(paths, binary)]
+        if indexes[-1] is not None:
+            line_count = len(indexes[-1]) - 1
+        else:
+            with open_file(paths[-1]) as f:   # count lines
+                line_count = sum(1 for _ in f)
+    debug('total line count: {}'.format(line_count))
+
+    # one pass through each shard (a single shard is the entire dataset)
+    batch_iterator = functools.partial(batch_iterator, cycle=False)
+
+    def shard_batches(shard):
+        """ Batches of the current shard, starting at the current offset """
+        rng = random.Random('{} {} {}'.format(state.seed, state.epoch, state.shard))
+        for i, batch in enumerate(batch_iterator(shard, rng=rng)):
+            if i >= state.offset:
+                state.offset = i + 1
+                yield batch
+        state.offset = 0
+
+    cached = cache_dir is not None and not any(binary or [])
+    if shard_mode == 'random' and not cached and any(is_compressed(path) for path in paths):
+        # each read in a compressed file means decompressing it up to this position
+        warn('random shard mode is not supported with compressed files: using sequential mode')
+        shard_mode = 'sequential'
 
-    shard, position = read_shard()
     if not max_size or line_count <= max_size:
         # training set is small enough to fit entirely into memory (single shard)
-        return batch_iterator(shard), line_count
-    else:
-        batch_iterator = functools.partial(batch_iterator, cycle=False)
+        shard, _ = read_shard()
 
-        def generator(position, shard):
+        def generator():
             while True:
+                yield from shard_batches(list(shard))   # each epoch starts from the same order
+                state.epoch += 1
+    elif shard_mode == 'random':
+        # each shard is a random set of blocks: line indexes give constant-time access to any block,
+        # and only one shard is in memory at a time
+        block_size = min(block_size, max_size)   # the lines after `max_size` in a shard would be ignored
+        block_count = int(math.ceil(line_count / block_size))
+        blocks_per_shard = max(1, max_size // block_size)
+
+        def generator():
+            state.shard = state.shard or 0
+            while True:
+                blocks = list(range(block_count))
+                random.Random('{} {}'.format(state.seed, state.epoch)).shuffle(blocks)
+                while state.shard * blocks_per_shard < block_count:
+                    i = state.shard * blocks_per_shard
+                    line_ids = np.concatenate([
+                        np.arange(block * block_size, min((block + 1) * block_size, line_count))
+                        for block in sorted(blocks[i:i + blocks_per_shard])   # sorted, for faster reads
+                    ])
+                    shard, _ = read_shard(line_ids=line_ids)
+                    yield from shard_batches(shard)
+                    state.shard += 1
+                state.epoch += 1
+                state.shard = 0
+    else:
+        # shards are identified by their starting position (None for the first shard)
+        def generator():
+            while True:
+                shard, position = read_shard(from_position=state.shard)
+                yield from shard_batches(shard)
+
                 if len(shard) < max_size:
                     # last shard, start again from the beginning of the dataset
-                    position = None
+                    state.epoch += 1
+                    state.shard = None
+                else:
+                    state.shard = list(position)
 
-                size = 0
-                for batch in batch_iterator(shard):
-                    size += len(batch)
-                    yield batch
+    return generator(), line_count
 
-                    if size >= len(shard):  # cycle through this shard only once, then read next shard
-                        shard, position = read_shard(from_position=position)
-                        break
 
-        return generator(position, shard), line_count
+def prefetch_iterator(iterator, fun, queue_size=0, workers=1, processes=False, key=None):
+    """
+    Apply `fun` to the elements of `iterator` ahead of time, in background workers, and yield
+    pairs `(element, fun(element))` in the same order as `iterator`.
+
+    This is used to prepare training batches (padding and conversion to numpy arrays) while
+    TensorFlow is busy with the previous training step.
+
+    :param iterator: iterator whose elements are given to `fun` (it is consumed by a single background thread)
+    :param fun: function to apply to each element (must be picklable if `processes` is True)
+    :param queue_size: maximum number of elements which are prepared ahead of time (if 0, `fun` is called
+      synchronously, when the next element is requested)
+    :param workers: number of threads or processes calling `fun`
+    :param processes: use worker processes instead of threads (avoids the GIL, but elements and results
+      need to be pickled)
+    :param key: if not None, `fun` is applied to `key(element)` instead of `element` (`key` is called by
+      the background thread which consumes `iterator`)
+    """
+    if key is not None:
+        iterator = ((element, key(element)) for element in iterator)
+    else:
+        iterator = ((element, element) for element in iterator)
+
+    if not queue_size or queue_size <= 0:
+        for element, arg in iterator:
+            yield element, fun(arg)
+        return
+
+    if processes:
+        executor = futures.ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn'))
+    else:
+        executor = futures.ThreadPoolExecutor(max_workers=workers)
+
+    queue_ = queue.Queue(maxsize=queue_size)
+    end = object()
+
+    def produce():
+        try:
+            for element, arg in iterator:
+                queue_.put((element, executor.submit(fun, arg)))
+        except Exception as e:
+            future = futures.Future()
+            future.set_exception(e)
+            queue_.put((None, future))
+        queue_.put(end)
+
+    thread = threading.Thread(target=produce, daemon=True)
+    thread.start()
+
+    try:
+        while True:
+            item = queue_.get()
+            if item is end:
+                break
+            element, future = item
+            yield element, future.result()
+    finally:
+        executor.shutdown(wait=False)
 
 
 def get_batches(data, batch_size, batches=0, allow_smaller=True):
@@ -445,9 +1115,19 @@ def read_binary_features(filename, from_position=None):
 
     Use `scripts/speech/extract-audio-features.py` or `scripts/speech/extract.py` to create such a file for audio (MFCCs).
 
+    Files in the indexed format (see `write_indexed_features`) are also supported. In this case, entries
+    are memory-mapped, and positions are entry numbers instead of byte offsets.
+
     :param filename: path to the binary file containing the features
     :return: list of arrays of shape (frames, dimension)
     """
+    if is_indexed_features(filename):
+        table, data = read_indexed_features(filename)
+        start = from_position or 0
+        for i, (offset, frames) in enumerate(table[start:].tolist(), start + 1):
+            yield data[offset:offset + frames], i
+        return
+
     with open(filename, 'rb') as f:
         lines, dim = np.load(f)
         if from_position is not None:
@@ -461,15 +1141,237 @@ def read_binary_features(filename, from_position=None):
                 pass
 
 
+_FEATURES_MAGIC = b'\x93FEATS\x01\x00'
+_FEATURES_HEADER = '<qqq'   # number of entries, dimension, total number of frames
+
+
+def write_indexed_features(filename, features, dim):
+    """
+    Write vector features in the indexed format: a header, followed by one contiguous float32 buffer
+    of shape (total_frames, dim) with all the entries, and a table of shape (entries, 2), which
+    gives the (offset, frames) of each entry in this buffer.
+
+    Contrary to the sequential format of `read_binary_features`, this format can be memory-mapped and
+    gives constant-time access to any entry (see `read_indexed_features`).
+
+    :param filename: path to the output file
+    :param features: iterable of arrays of shape (frames, dim)
+    :param dim: dimension of the feature vectors
+    """
+    table = []
+    total_frames = 0
+
+    with open(filename, 'wb') as f:
+        f.write(_FEATURES_MAGIC)
+        f.write(struct.pack(_FEATURES_HEADER, 0, dim, 0))   # header is written at the end
+
+        for feats in features:
+            feats = np.asarray(feats, dtype='<f4').reshape(-1, dim)
+            table.append((total_frames, len(feats)))
+            f.write(feats.tobytes())
+            total_frames += len(feats)
+
+        np.array(table, dtype='<i8').reshape(-1, 2).tofile(f)
+        f.seek(len(_FEATURES_MAGIC))
+        f.write(struct.pack(_FEATURES_HEADER, len(table), dim, total_frames))
+
+
+def is_indexed_features(filename):
+    with open(filename, 'rb') as f:
+        return f.read(len(_FEATURES_MAGIC)) == _FEATURES_MAGIC
+
+
+_indexed_features = {}
+
+
+def read_indexed_features(filename):
+    """
+    Memory-map a feature file in the indexed format (see `write_indexed_features`).
+
+    :param filename: path to the binary file containing the features
+    :return: pair of arrays (table, data), where entry `i` is
+      `data[table[i, 0]:table[i, 0] + table[i, 1]]`
+    """
+    if filename not in _indexed_features:
+        header_size = len(_FEATURES_MAGIC) + struct.calcsize(_FEATURES_HEADER)
+        with open(filename, 'rb') as f:
+            f.seek(len(_FEATURES_MAGIC))
+            lines, dim, total_frames = struct.unpack(_FEATURES_HEADER, f.read(struct.calcsize(_FEATURES_HEADER)))
+
+        if total_frames > 0:
+            data = np.memmap(filename, dtype='<f4', mode='r', offset=header_size, shape=(total_frames, dim))
+        else:   # numpy can't map empty arrays
+            data = np.zeros((0, dim), dtype=np.float32)
+
+        if lines > 0:
+            table_offset = header_size + total_frames * dim * 4
+            table = np.memmap(filename, dtype='<i8', mode='r', offset=table_offset, shape=(lines, 2))
+        else:
+            table = np.zeros((0, 2), dtype=np.int64)
+
+        _indexed_features[filename] = table, data
+
+    return _indexed_features[filename]
+
+
+def read_features_at(filename, line_ids):
+    """
+    Random access to the entries of a feature file in the indexed format.
+
+    :param filename: path to the binary file containing the features
+    :param line_ids: iterable of entry numbers
+    :return: iterator over the arrays of shape (frames, dim) at those positions
+    """
+    table, data = read_indexed_features(filename)
+    for line_id in line_ids:
+        offset, frames = table[line_id].tolist()
+        yield data[offset:offset + frames]
+
+
+def scan_binary_features(filename):
+    """
+    Find the byte offset of each entry in a feature file in the sequential format (see `read_binary_features`),
+    by reading the numpy headers only.
+
+    :return: tuple (offsets, dim)
+    """
+    offsets = []
+    with open(filename, 'rb') as f:
+        lines, dim = np.load(f)
+        for _ in range(lines):
+            offsets.append(f.tell())
+            version = np.lib.format.read_magic(f)
+            if version == (1, 0):
+                shape, _, dtype = np.lib.format.read_array_header_1_0(f)
+            else:
+                shape, _, dtype = np.lib.format.read_array_header_2_0(f)
+            f.seek(int(np.prod(shape)) * dtype.itemsize, os.SEEK_CUR)
+
+    return offsets, int(dim)
+
+
 def read_lines(paths, binary=None):
     binary = binary or [False] * len(paths)
     return zip(*[sys.stdin if path is None else
                  map(operator.itemgetter(0), read_binary_features(path)) if binary_
-                 else open(path)
+                 else open_file(path)
                  for path, binary_ in zip(paths, binary)])
 
 
+def build_line_index(filename, index_filename=None):
+    """
+    Scan a text file, and compute the byte offset of the beginning of each line
+    (in the decompressed data, for compressed files).
+
+    :param filename: path to the text file
+    :param index_filename: if not None, save the index to this file (numpy format)
+    :return: int64 array of size `lines + 1` (the last value is the size of the file)
+    """
+    debug('building line index for {}'.format(filename))
+    offsets = array.array('q', [0])
+    with open_file(filename, 'rb') as f:
+        for line in f:
+            offsets.append(offsets[-1] + len(line))
+    offsets = np.frombuffer(offsets, dtype=np.int64)
+
+    if index_filename is not None:
+        suffix = '.{}.tmp'.format(os.getpid())
+        try:
+            with open(index_filename + suffix, 'wb') as index_file:
+                np.save(index_file, offsets)
+            os.replace(index_filename + suffix, index_filename)
+        except OSError:   # e.g., read-only data directory
+            warn('unable to write line index {}'.format(index_filename))
+
+    return offsets
+
+
+_line_indexes = {}
+
+
+def get_line_index(filename, build=True):
+    """
+    Read the line index of a text file, stored next to it (with a `.lines.npy` suffix). This index
+    gives the number of lines in constant time, and allows to seek to any line.
+
+    :param filename: path to the text file
+    :param build: build the index if it doesn't exist (or if it is older than the text file)
+    :return: int64 array of size `lines + 1` (see `build_line_index`), or None if there is no index
+    """
+    index_filename = filename + '.lines.npy'
+    stat = os.stat(filename)
+    key = (filename, stat.st_size, stat.st_mtime_ns)
+
+    if key not in _line_indexes:
+        offsets = None
+        if os.path.exists(index_filename) and os.stat(index_filename).st_mtime_ns >= stat.st_mtime_ns:
+            offsets = np.load(index_filename, mmap_mode='r')
+            if offsets[-1] != stat.st_size and not is_compressed(filename):  # stale index
+                offsets = None
+        if offsets is None and build:
+            offsets = build_line_index(filename, index_filename)
+        if offsets is None:
+            return None
+        _line_indexes[key] = offsets
+
+    return _line_indexes[key]
+
+
+def universal_newline(line):
+    """
+    Line separators are converted to '\n' by `open` in text mode (universal newlines). Readers which split
+    lines on '\n' (like the line index) use this function to get the same lines from CRLF files.
+    """
+    return line[:-2] + '\n' if line.endswith('\r\n') else line
+
+
+_text_streams = {}
+
+
+def read_compressed_text_from_position(filename, from_position=None):
+    """
+    Read a compressed text file from a given position (byte offset in the decompressed data).
+
+    Seeking in a compressed stream means decompressing all the data before this position. To avoid this,
+    the decompression stream is kept open when the reader is closed, and a reader which starts at
+    the position where the last one stopped (e.g., when reading the next shard of a corpus) continues
+    from this stream. Other positions are reached by decompressing from the beginning of the file.
+    """
+    position = from_position or 0
+    f, position_ = _text_streams.pop(filename, (None, None))
+
+    if f is None or position_ != position:
+        if f is not None:
+            f.close()
+        f = open_file(filename, 'rb')
+        if position:
+            debug('seeking to position {} in compressed file {}'.format(position, filename))
+            f.seek(position)
+
+    try:
+        for line in f:
+            position += len(line)
+            yield universal_newline(line.decode()), position
+    finally:
+        _text_streams[filename] = f, position
+
+
 def read_text_from_position(filename, from_position=None):
+    if is_compressed(filename):
+        yield from read_compressed_text_from_position(filename, from_position)
+        return
+
+    offsets = get_line_index(filename, build=False)
+
+    if offsets is not None:   # no need to call `tell` after each line, position is given by the index
+        start = 0 if from_position is None else int(np.searchsorted(offsets, from_position))
+        # same line separator as the index ('\r\n' is converted to '\n' by `universal_newline`)
+        with open(filename, newline='\n') as f:
+            f.seek(int(offsets[start]))
+            for line, position in zip(f, offsets[start + 1:].tolist()):
+                yield universal_newline(line), position
+        return
+
     with open(filename) as f:
         if from_position is not None:
             f.seek(from_position)
@@ -480,6 +1382,27 @@ def read_text_from_position(filename, from_position=None):
             yield line, f.tell()
 
 
+def read_text_at(filename, line_ids, offsets=None):
+    """
+    Random access to the lines of a text file, using its line index.
+    Compressed files are supported, but each backward seek means decompressing the file from the beginning,
+    so `line_ids` should be sorted.
+
+    :param filename: path to the text file
+    :param line_ids: iterable of line numbers
+    :param offsets: line index of this file (see `get_line_index`)
+    :return: iterator over the lines at those positions (in the same order as `line_ids`)
+    """
+    if offsets is None:
+        offsets = get_line_index(filename)
+
+    with open_file(filename, 'rb') as f:
+        for line_id in line_ids:
+            start, end = offsets[line_id:line_id + 2].tolist()
+            f.seek(start)
+            yield universal_newline(f.read(end - start).decode())
+
+
 def read_lines_from_position(paths, from_position=None, binary=None):
     binary = binary or [False] * len(paths)
     from_position = from_position or [None] * len(paths)
@@ -494,6 +1417,50 @@ def read_lines_from_position(paths, from_position=None, binary=None):
         yield tuple(zip(*data))
 
 
+_feature_offsets = {}
+
+
+def read_binary_features_at(filename, line_ids):
+    """
+    Random access to the entries of a feature file, in the indexed format (see `read_features_at`)
+    or in the sequential format (whose entry offsets are found once with `scan_binary_features`).
+    """
+    if is_indexed_features(filename):
+        yield from read_features_at(filename, line_ids)
+        return
+
+    if filename not in _feature_offsets:
+        _feature_offsets[filename], _ = scan_binary_features(filename)
+    offsets = _feature_offsets[filename]
+
+    with open(filename, 'rb') as f:
+        for line_id in line_ids:
+            f.seek(offsets[line_id])
+            yield list(np.load(f))
+
+
+def read_lines_at(paths, line_ids, binary=None):
+    """
+    Random access version of `read_lines_from_position`. Text files are accessed through their
+    line index (see `get_line_index`).
+
+    :param paths: list of files (text or binary features), which must have the same number of lines
+    :param line_ids: list of line numbers
+    :param binary: which files contain binary features
+    :return: iterator over pairs `(inputs, positions)`, where positions are line numbers (of the next line)
+    """
+    binary = binary or [False] * len(paths)
+    line_ids = [int(line_id) for line_id in line_ids]
+
+    iterators = [
+        read_binary_features_at(path, line_ids) if binary_ else read_text_at(path, line_ids)
+        for path, binary_ in zip(paths, binary)
+    ]
+
+    for line_id, inputs in zip(line_ids, zip(*iterators)):
+        yield inputs, (line_id + 1,) * len(paths)
+
+
 def create_logger(log_file=None):
     """
     Initialize global logger and return it.